@@ -2,7 +2,8 @@ CREATE TABLE IF NOT EXISTS reminders (
   id BIGSERIAL PRIMARY KEY,
 
   user_id BIGINT REFERENCES users (id) ON DELETE CASCADE,
-  guild_id BIGINT REFERENCES guilds (id) ON DELETE CASCADE,
+  guild_id BIGINT NOT NULL REFERENCES guilds (id) ON DELETE CASCADE,
+  shard_id INTEGER NOT NULL,  -- Derived from guild_id and SHARD_COUNT, updated on startup
 
   channel_id BIGINT NOT NULL REFERENCES channels (id) ON DELETE CASCADE,
   thread_id BIGINT,  -- Due to thread archiving we do not save thread info
@@ -15,3 +16,4 @@ CREATE TABLE IF NOT EXISTS reminders (
 );
 
 CREATE INDEX IF NOT EXISTS reminders_guild_id_expires_at_idx ON reminders (guild_id, expires_at);
+CREATE INDEX IF NOT EXISTS reminders_shard_id_expires_at_idx ON reminders (shard_id, expires_at);
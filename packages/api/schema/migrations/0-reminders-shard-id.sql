@@ -0,0 +1,12 @@
+-- Stores the shard ID of reminders so shards can look up due reminders using an index
+-- Run using psql -v shard_count=<SHARD_COUNT>, the API updates shard IDs on startup after changing the shard count
+
+-- Reminders without a guild can not be delivered
+DELETE FROM reminders WHERE guild_id IS NULL;
+ALTER TABLE reminders ALTER COLUMN guild_id SET NOT NULL;
+
+ALTER TABLE reminders ADD COLUMN IF NOT EXISTS shard_id INTEGER;
+UPDATE reminders SET shard_id = (guild_id >> 22) % :shard_count;
+ALTER TABLE reminders ALTER COLUMN shard_id SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS reminders_shard_id_expires_at_idx ON reminders (shard_id, expires_at);
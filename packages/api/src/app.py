@@ -25,7 +25,7 @@ import aredis
 import asyncpg
 from starlette.applications import Starlette
 
-from .config import PSQL_DSN, REDIS_URL
+from .config import PSQL_DSN, REDIS_URL, SHARD_COUNT
 from .middleware import register_middleware
 from .routes import router
 
@@ -51,6 +51,13 @@ async def on_startup():
     app.redis = aredis.StrictRedis.from_url(str(REDIS_URL))
     app.db = await asyncpg.create_pool(str(PSQL_DSN), init=init_pg_connection)
 
+    # Shard IDs of reminders are stored to look them up using an index, which change with the shard count
+    async with app.db.acquire() as conn:
+        await conn.execute(
+            'UPDATE reminders SET shard_id = (guild_id >> 22) % $1 WHERE shard_id != (guild_id >> 22) % $1',
+            SHARD_COUNT,
+        )
+
     app.session = aiohttp.ClientSession(headers={'User-Agent': f'Mousey/4.0 (+https://github.com/LostLuma/Mousey)'})
 
 
@@ -18,6 +18,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import datetime
+
 from starlette.exceptions import HTTPException
 from starlette.responses import JSONResponse
 from starlette.routing import Router
@@ -44,21 +46,30 @@ def serialize_reminder(data):
 async def get_reminders(request):
     try:
         shard_id = int(request.query_params['shard_id'])
-        limit = int(request.query_params.get('limit', 1))
+        horizon = request.query_params.get('horizon')
+
+        # Without a horizon only the next reminder is returned by default
+        limit = request.query_params.get('limit', 1 if horizon is None else None)
+        limit = None if limit is None else int(limit)
+
+        if horizon is None:
+            expires_before = datetime.datetime.max
+        else:
+            expires_before = datetime.datetime.utcnow() + datetime.timedelta(seconds=int(horizon))
     except (KeyError, ValueError):
-        raise HTTPException(400, 'Invalid or missing "shard_id" or "limit" query param.')
+        raise HTTPException(400, 'Invalid or missing "shard_id", "limit" or "horizon" query param.')
 
     async with request.app.db.acquire() as conn:
         records = await conn.fetch(
             """
             SELECT id, user_id, guild_id, channel_id, thread_id, message_id, referenced_message_id, expires_at, message
             FROM reminders
-            WHERE (guild_id >> 22) % $2 = $1
+            WHERE shard_id = $1 AND expires_at <= $2
             ORDER BY expires_at ASC
             LIMIT $3
             """,
             shard_id,
-            SHARD_COUNT,
+            expires_before,
             limit,
         )
 
@@ -99,13 +110,14 @@ async def post_reminders(request):
         reminder_id = await conn.fetchval(
             """
             INSERT INTO reminders (
-              user_id, guild_id, channel_id, thread_id, message_id, referenced_message_id, expires_at, message
+              user_id, guild_id, shard_id, channel_id, thread_id, message_id, referenced_message_id, expires_at, message
             )
-            VALUES ($1, $2, $3, $4,$5, $6, $7, $8)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
             RETURNING id
             """,
             user['id'],
             guild_id,
+            (guild_id >> 22) % SHARD_COUNT,
             channel_id,
             thread_id,
             message_id,
@@ -117,6 +129,23 @@ async def post_reminders(request):
     return JSONResponse({'id': reminder_id})
 
 
+@router.route('/reminders', methods=['DELETE'])
+@is_authorized
+@has_permissions(administrator=True)
+async def delete_reminders(request):
+    data = await request.json()
+
+    try:
+        reminder_ids = list(map(int, data['ids']))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(400, 'Invalid or missing "ids" JSON field.')
+
+    async with request.app.db.acquire() as conn:
+        records = await conn.fetch('DELETE FROM reminders WHERE id = ANY($1) RETURNING id', reminder_ids)
+
+    return JSONResponse({'ids': [x['id'] for x in records]})
+
+
 @router.route('/reminders/{id:int}', methods=['GET'])
 @is_authorized
 @has_permissions(administrator=True)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Checks the channel history query is answered using the channel index on every partition,
+# Usage: PSQL_DSN=postgres://... python benchmarks/history_plan.py
+
+import asyncio
+import datetime
+import json
+import os
+import pathlib
+import random
+import sys
+
+import asyncpg
+
+
+SCHEMA_PATH = pathlib.Path(__file__).parent.parent / 'schema' / '0-messages.sql'
+
+# Everything is created in this schema, which is dropped afterwards
+SCHEMA_NAME = 'history_plan'
+
+DAYS = 3
+CHANNELS = 100
+MESSAGES_PER_DAY = 100_000
+
+DISCORD_EPOCH = 1420070400000
+
+# Same query as Messages._fetch_history
+HISTORY_QUERY = """
+SELECT id, author_id, channel_id, data, content, embeds, attachments, edited_at, deleted_at, webhook_author_id
+FROM messages
+WHERE channel_id = $1 AND id < $2 AND id > $3
+ORDER BY id DESC
+LIMIT $4
+"""
+
+
+def time_snowflake(value):
+    return int(value.timestamp() * 1000 - DISCORD_EPOCH) << 22
+
+
+def plan_scans(plan):
+    """Yields all nodes of a plan which read from a table."""
+
+    if 'Relation Name' in plan:
+        yield plan
+
+    for child in plan.get('Plans', ()):
+        yield from plan_scans(child)
+
+
+async def seed(conn):
+    await conn.execute(SCHEMA_PATH.read_text())
+
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    for offset in range(DAYS):
+        day = today - datetime.timedelta(days=offset)
+
+        lower = time_snowflake(day)
+        upper = time_snowflake(day + datetime.timedelta(days=1))
+
+        await conn.execute(
+            f'CREATE TABLE messages_{day:%Y%m%d} PARTITION OF messages FOR VALUES FROM ({lower}) TO ({upper})'
+        )
+
+        ids = set()
+
+        while len(ids) < MESSAGES_PER_DAY:
+            ids.add(random.randrange(lower, upper))
+
+        records = [(x, random.randrange(CHANNELS), random.randbytes(64)) for x in ids]
+        await conn.copy_records_to_table(
+            'messages', records=records, columns=('id', 'channel_id', 'data'), schema_name=SCHEMA_NAME
+        )
+
+    await conn.execute('ANALYZE messages')
+
+    return time_snowflake(today - datetime.timedelta(days=DAYS - 1)), time_snowflake(today + datetime.timedelta(days=1))
+
+
+async def check_plans(conn, after, before):
+    await conn.execute(f'PREPARE history (BIGINT, BIGINT, BIGINT, INTEGER) AS {HISTORY_QUERY}')
+
+    failed = False
+
+    # Prepared statements switch to a generic plan after being executed a few times
+    for mode in ('force_custom_plan', 'force_generic_plan'):
+        await conn.execute(f'SET plan_cache_mode = {mode}')
+
+        for channel_id, limit in ((0, 1), (1, 100), (CHANNELS // 2, 1_000)):
+            plan = await conn.fetchval(
+                f'EXPLAIN (FORMAT JSON) EXECUTE history ({channel_id}, {before}, {after}, {limit})'
+            )
+            plan = json.loads(plan)[0]['Plan']
+
+            scans = list(plan_scans(plan))
+            # Indexes created on the partitioned table are named after each partition
+            bad = [x for x in scans if not x.get('Index Name', '').endswith('_channel_id_id_idx')]
+
+            print(f'{mode} channel={channel_id} limit={limit}: {len(scans) - len(bad)}/{len(scans)} index scans')
+
+            for scan in bad:
+                failed = True
+                print(f'  {scan["Node Type"]} on {scan["Relation Name"]} {scan.get("Index Name", "")}'.rstrip())
+
+    return not failed
+
+
+async def main():
+    conn = await asyncpg.connect(os.environ['PSQL_DSN'])
+
+    try:
+        await conn.execute(f'CREATE SCHEMA {SCHEMA_NAME}')
+        await conn.execute(f'SET search_path = {SCHEMA_NAME}')
+
+        after, before = await seed(conn)
+        return await check_plans(conn, after, before)
+    finally:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA_NAME} CASCADE')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(0 if asyncio.run(main()) else 1)
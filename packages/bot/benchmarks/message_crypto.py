@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Measures how long the event loop stalls while encrypting and decrypting message batches,
+# Usage (with the environment of the bot): python -m benchmarks.message_crypto
+
+import asyncio
+import random
+import string
+import time
+
+from src.plugins.messages.plugin import (
+    MESSAGE_COLUMNS,
+    _map_list,
+    decrypt_message,
+    decrypt_messages,
+    encrypt_message,
+    encrypt_messages,
+)
+
+
+SIZES = (100, 1_000, 10_000)
+
+# Expected interval of the probe measuring stalls, close to how often the gateway is read
+PROBE_INTERVAL = 0.001
+
+
+def create_messages(count):
+    return [
+        {
+            'id': random.randrange(2 ** 62),
+            'author_id': random.randrange(2 ** 62),
+            'channel_id': random.randrange(2 ** 62),
+            'content': ''.join(random.choices(string.ascii_letters + ' ', k=random.randrange(10, 400))),
+            'embeds': [],
+            'attachments': [],
+            'edited_at': None,
+            'deleted_at': None,
+            'webhook_author_id': None,
+        }
+        for _ in range(count)
+    ]
+
+
+async def measure(coro):
+    """Returns the duration of a coroutine and the longest stall of the event loop while it runs."""
+
+    stalls = []
+
+    async def probe():
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            stalls.append(time.perf_counter() - started_at - PROBE_INTERVAL)
+
+    task = asyncio.create_task(probe())
+    await asyncio.sleep(0)  # Let the probe start
+
+    started_at = time.perf_counter()
+    await coro
+    duration = time.perf_counter() - started_at
+
+    # The probe only notices a stall once it is able to run again
+    await asyncio.sleep(PROBE_INTERVAL * 2)
+    task.cancel()
+
+    return duration, max(stalls)
+
+
+async def run_inline(func, items):
+    return _map_list(func, items)
+
+
+async def main():
+    for size in SIZES:
+        messages = create_messages(size)
+        records = [dict(zip(MESSAGE_COLUMNS, x)) for x in map(encrypt_message, messages)]
+
+        runs = (
+            ('encrypt inline', run_inline(encrypt_message, messages)),
+            ('encrypt executor', encrypt_messages(messages)),
+            ('decrypt inline', run_inline(decrypt_message, records)),
+            ('decrypt executor', decrypt_messages(records)),
+        )
+
+        for name, coro in runs:
+            duration, stall = await measure(coro)
+            print(f'{name:>16} {size:>6} messages: {duration * 1000:>8.1f}ms total, {stall * 1000:>8.1f}ms max stall')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Compares the throughput of persisting messages using multirow INSERTs and COPY,
+# Usage (with the environment of the bot): python -m benchmarks.message_flush
+
+import asyncio
+import os
+import pathlib
+import random
+import time
+
+import asyncpg
+from src.plugins.messages.plugin import COPY_THRESHOLD, Messages
+
+
+# Everything is created in this schema, which is dropped afterwards
+SCHEMA_NAME = 'message_flush'
+
+SCHEMA_PATH = pathlib.Path(__file__).parent.parent / 'schema' / '0-messages.sql'
+
+SIZES = (1_000, 10_000, 100_000)
+
+
+def create_rows(count):
+    # Rows are ordered as in MESSAGE_COLUMNS
+    return [
+        (x, random.randrange(2 ** 62), random.randrange(100), random.randbytes(200), None, None, None)
+        for x in random.sample(range(2 ** 62), count)
+    ]
+
+
+async def measure(conn, method, rows):
+    await conn.execute('TRUNCATE messages')
+
+    # Rows are first inserted and then written again as updates of every message
+    durations = []
+
+    for _ in range(2):
+        started_at = time.perf_counter()
+        # Neither method uses any state of the plugin
+        await method(None, conn, rows)
+        durations.append(time.perf_counter() - started_at)
+
+    return durations
+
+
+async def main():
+    conn = await asyncpg.connect(os.environ['PSQL_DSN'])
+
+    try:
+        await conn.execute(f'CREATE SCHEMA {SCHEMA_NAME}')
+        await conn.execute(f'SET search_path = {SCHEMA_NAME}')
+
+        await conn.execute(SCHEMA_PATH.read_text())
+        # Rows are written to a single partition, as most messages in a flush are sent on the same day
+        await conn.execute('CREATE TABLE messages_default PARTITION OF messages DEFAULT')
+
+        print(f'Flushes of at least {COPY_THRESHOLD} messages use COPY')
+
+        for size in SIZES:
+            rows = create_rows(size)
+
+            for name, method in (('INSERT', Messages._insert_messages), ('COPY', Messages._copy_messages)):
+                inserted, updated = await measure(conn, method, rows)
+                print(
+                    f'{name:>6} {size:>7} rows: {size / inserted:>9,.0f} rows/s new, {size / updated:>9,.0f} rows/s updated'
+                )
+    finally:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA_NAME} CASCADE')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
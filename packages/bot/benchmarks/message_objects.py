@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Measures the time and memory needed to construct many message objects,
+# Usage (with the environment of the bot): python -m benchmarks.message_objects
+
+import random
+import time
+import tracemalloc
+
+from src.plugins.messages.message import Message
+from src.plugins.messages.plugin import MESSAGE_COLUMNS, decrypt_message, encrypt_message, lazy_message
+
+
+COUNT = 100_000
+
+EMBED = {'title': 'Title', 'description': 'Description', 'fields': [{'name': 'Name', 'value': 'Value'}]}
+ATTACHMENT = '/attachments/860146218238550016/860146218238550017/image.png'
+
+
+def create_records(count):
+    messages = [
+        {
+            'id': random.randrange(2 ** 62),
+            'author_id': random.randrange(2 ** 62),
+            'channel_id': random.randrange(2 ** 62),
+            'content': 'Hello world!',
+            'embeds': [EMBED] if random.random() < 0.1 else [],
+            'attachments': [ATTACHMENT] if random.random() < 0.1 else [],
+            'edited_at': None,
+            'deleted_at': None,
+            'webhook_author_id': None,
+        }
+        for _ in range(count)
+    ]
+
+    return [dict(zip(MESSAGE_COLUMNS, encrypt_message(x))) for x in messages]
+
+
+def measure(name, func, items):
+    tracemalloc.start()
+
+    started_at = time.perf_counter()
+    result = list(map(func, items))
+    duration = time.perf_counter() - started_at
+
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{name:>24}: {duration * 1000:>8.1f}ms, {size / 1024 / 1024:>6.1f}MiB')
+    return result
+
+
+def main():
+    records = create_records(COUNT)
+    print(f'{COUNT} messages')
+
+    # Looked up messages are decrypted upfront, iterating channel history decrypts them on first access
+    decrypted = list(map(decrypt_message, records))
+
+    measure('decrypted', lambda x: Message(**x, author=None, channel=None), decrypted)
+    messages = measure('lazy', lambda x: Message(**lazy_message(x), author=None, channel=None), records)
+
+    measure('content accessed', lambda x: x.content, messages)
+    measure('embeds accessed', lambda x: x.embeds, messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,29 @@
+-- Partitions per day are created and dropped by the bot
 CREATE TABLE IF NOT EXISTS messages (
   id BIGINT PRIMARY KEY,
 
   author_id BIGINT,  -- NULL to distinguish webhook messages
   channel_id BIGINT NOT NULL,
 
-  content BYTEA NOT NULL,
+  data BYTEA,  -- Versioned payload containing content, embeds and attachments
 
-  embeds BYTEA[] NOT NULL DEFAULT '{}',
-  attachments BYTEA[] NOT NULL DEFAULT '{}',
+  -- Legacy format with every field encrypted separately, NULL once migrated
+  content BYTEA,
+  embeds BYTEA[],
+  attachments BYTEA[],
 
   edited_at TIMESTAMP WITH TIME ZONE,
-  deleted_at TIMESTAMP WITH TIME ZONE
+  deleted_at TIMESTAMP WITH TIME ZONE,
+
+  webhook_author_id BIGINT  -- References message_authors, NULL for legacy webhook messages
+) PARTITION BY RANGE (id);
+
+-- Used to look up channel history, created on every partition
+CREATE INDEX IF NOT EXISTS messages_channel_id_id_idx ON messages (channel_id, id DESC);
+
+-- Webhook authors, shared by all messages with an identical author
+CREATE TABLE IF NOT EXISTS message_authors (
+  id BIGINT PRIMARY KEY,  -- Keyed hash of the author
+  data BYTEA NOT NULL,
+  updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
 );
@@ -0,0 +1,12 @@
+-- Adds the single payload column to messages
+-- Existing rows are rewritten in batches by the Messages plugin
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS data BYTEA;
+
+ALTER TABLE messages ALTER COLUMN content DROP NOT NULL;
+
+ALTER TABLE messages ALTER COLUMN embeds DROP NOT NULL;
+ALTER TABLE messages ALTER COLUMN embeds DROP DEFAULT;
+
+ALTER TABLE messages ALTER COLUMN attachments DROP NOT NULL;
+ALTER TABLE messages ALTER COLUMN attachments DROP DEFAULT;
@@ -0,0 +1,37 @@
+-- Converts messages into a table partitioned by id
+-- Existing rows are kept as one partition, which is dropped once all of them expired
+
+-- The legacy partition holds messages sent until the end of the next day (UTC),
+-- Validating its bounds upfront allows attaching it without scanning the table while it is locked
+DO $$
+DECLARE
+  upper BIGINT := (
+    EXTRACT(EPOCH FROM date_trunc('day', now() AT TIME ZONE 'UTC') + INTERVAL '2 days') * 1000 - 1420070400000
+  )::BIGINT << 22;
+BEGIN
+  EXECUTE format('ALTER TABLE messages ADD CONSTRAINT messages_legacy_bounds CHECK (id < %s) NOT VALID', upper);
+END $$;
+
+ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_bounds;
+
+BEGIN;
+
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER INDEX messages_pkey RENAME TO messages_legacy_pkey;
+
+CREATE TABLE messages (LIKE messages_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (id);
+ALTER TABLE messages ADD PRIMARY KEY (id);
+
+-- Partition bounds are only checked against the constraint, which is redundant once attached
+DO $$
+DECLARE
+  upper BIGINT := (
+    EXTRACT(EPOCH FROM date_trunc('day', now() AT TIME ZONE 'UTC') + INTERVAL '2 days') * 1000 - 1420070400000
+  )::BIGINT << 22;
+BEGIN
+  EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%s)', upper);
+END $$;
+
+ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_bounds;
+
+COMMIT;
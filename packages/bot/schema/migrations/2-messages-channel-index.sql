@@ -0,0 +1,4 @@
+-- Adds the channel history index to all existing partitions
+-- Note that this blocks writes to messages while the index is being built
+
+CREATE INDEX IF NOT EXISTS messages_channel_id_id_idx ON messages (channel_id, id DESC);
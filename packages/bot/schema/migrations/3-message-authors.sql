@@ -0,0 +1,9 @@
+-- Stores webhook authors once instead of per message in redis
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS webhook_author_id BIGINT;
+
+CREATE TABLE IF NOT EXISTS message_authors (
+  id BIGINT PRIMARY KEY,
+  data BYTEA NOT NULL,
+  updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
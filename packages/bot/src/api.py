@@ -152,8 +152,12 @@ class APIClient:
 
     # Reminders
 
-    async def get_reminders(self, shard_id, limit=1):
+    async def get_reminders(self, shard_id, limit=1, horizon=None):
         params = {'shard_id': shard_id, 'limit': limit}
+
+        if horizon is not None:
+            params['horizon'] = horizon
+
         return await self.request('GET', '/reminders', params=params)
 
     async def get_reminder(self, reminder_id):
@@ -168,6 +172,9 @@ class APIClient:
     async def delete_reminder(self, reminder_id):
         return await self.request('DELETE', f'/reminders/{reminder_id}')
 
+    async def delete_reminders(self, reminder_ids):
+        return await self.request('DELETE', '/reminders', json={'ids': reminder_ids})
+
     async def get_member_reminders(self, guild_id, member_id):
         return await self.request('GET', f'/guilds/{guild_id}/members/{member_id}/reminders')
 
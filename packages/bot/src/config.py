@@ -35,3 +35,6 @@ PSQL_URL = os.environ['PSQL_DSN']
 REDIS_URL = os.environ['REDIS_URL']
 
 SHARD_COUNT = int(os.environ['SHARD_COUNT'])
+
+# Pending writes are kept here until they are persisted
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', 'data/journal')
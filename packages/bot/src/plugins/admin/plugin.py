@@ -19,7 +19,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import asyncio
+import collections
 import datetime
+import time
 
 import discord
 from discord.ext import commands
@@ -33,6 +35,12 @@ from .enums import PruneStrategy
 # Moderator permissions - ignore these users unconditionally
 PERMISSIONS = discord.Permissions(administrator=True, ban_members=True, kick_members=True, manage_messages=True)
 
+# Member activity is reused for this many seconds, eg. when trying different amounts of days
+SNAPSHOT_TTL = 300
+
+# Amounts of days shown in the inactivity histogram
+HISTOGRAM_DAYS = (7, 14, 30, 60, 90, 180, 365)
+
 
 def has_any_role(role_ids):
     def check(member):
@@ -59,13 +67,26 @@ def should_prune_status(start):
     seen = should_prune_seen(start)
 
     def check(status):
-        return seen(status) and status.status is None or status.status < start
+        return seen(status) and (status.status is None or status.status < start)
 
     return check
 
 
+def last_active(strategy, status):
+    if strategy is PruneStrategy.seen:
+        return status.seen
+
+    return max(filter(None, (status.seen, status.status)), default=None)
+
+
 # TODO: Allow pruning members which are still pending?
 class Admin(Plugin):
+    def __init__(self, mousey):
+        super().__init__(mousey)
+
+        # Guild ID -> created at, members, statuses
+        self._snapshots = {}
+
     def cog_check(self, ctx):
         return ctx.author.guild_permissions.administrator
 
@@ -107,22 +128,84 @@ class Admin(Plugin):
 
         await self._prune_command(ctx, PruneStrategy.seen, roles, days)
 
-    async def _prune_command(self, ctx, strategy, roles, days):
-        if not roles:
-            members = ctx.guild.members
-        else:
-            role_ids = set(x.id for x in roles)
-            members = filter(has_any_role(role_ids), ctx.guild.members)
+    @prune.command('histogram', greedy_require_arg=False)
+    @bot_has_permissions(send_messages=True)
+    async def prune_histogram(self, ctx, roles: commands.Greedy[discord.Role]):
+        """
+        View how many members would be pruned for different amounts of days.
 
-        check = can_be_pruned(ctx.me.top_role)
-        members = list(filter(check, members))
+        Discord shows members pruned by `{prefix}prune`, Server members pruned by `{prefix}prune local`.
+        Including roles only counts members having one of them.
+
+        Roles can be specified using their mention, ID, or name.
+
+        Example: `{prefix}prune histogram`
+        Example: `{prefix}prune histogram Unverified`
+        """
+
+        members, statuses = await self._get_prunable_members(ctx, roles)
 
         if not members:
             await ctx.send('No members found to prune.')
             return
 
-        tracking = self.mousey.get_cog('Tracking')
-        statuses = await tracking.bulk_last_status(*members)
+        now = datetime.datetime.utcnow()
+
+        # Days inactive -> amount of members, None if never active
+        inactive = {x: collections.Counter() for x in PruneStrategy}
+
+        for status in statuses:
+            for strategy, counter in inactive.items():
+                active_at = last_active(strategy, status)
+                counter[None if active_at is None else (now - active_at).days] += 1
+
+        lines = [f'{"Days":>6} {"Discord":>8} {"Server":>8}']
+
+        for days in HISTOGRAM_DAYS:
+            counts = []
+
+            for strategy in (PruneStrategy.status, PruneStrategy.seen):
+                counter = inactive[strategy]
+                counts.append(counter[None] + sum(v for k, v in counter.items() if k is not None and k >= days))
+
+            lines.append(f'{days:>6} {counts[0]:>8} {counts[1]:>8}')
+
+        table = '\n'.join(lines)
+        await ctx.send(f'Members inactive for at least the amount of days:\n```\n{table}\n```')
+
+    async def _get_prunable_members(self, ctx, roles):
+        guild = ctx.guild
+        now = time.monotonic()
+
+        # Drop expired snapshots of all guilds
+        self._snapshots = {k: v for k, v in self._snapshots.items() if now - v[0] <= SNAPSHOT_TTL}
+        snapshot = self._snapshots.get(guild.id)
+
+        if snapshot is None:
+            members = [x for x in guild.members if not x.bot]
+            statuses = await self.mousey.get_cog('Tracking').bulk_last_status(*members) if members else []
+
+            snapshot = self._snapshots[guild.id] = time.monotonic(), members, statuses
+
+        check = can_be_pruned(ctx.me.top_role)
+        role_check = has_any_role(set(x.id for x in roles)) if roles else None
+
+        members = []
+        statuses = []
+
+        for member, status in zip(snapshot[1], snapshot[2]):
+            if check(member) and (role_check is None or role_check(member)):
+                members.append(member)
+                statuses.append(status)
+
+        return members, statuses
+
+    async def _prune_command(self, ctx, strategy, roles, days):
+        members, statuses = await self._get_prunable_members(ctx, roles)
+
+        if not members:
+            await ctx.send('No members found to prune.')
+            return
 
         now = datetime.datetime.utcnow()
         start = now - datetime.timedelta(days=days)
@@ -183,4 +266,7 @@ class Admin(Plugin):
                 else:
                     self.mousey.dispatch('mouse_member_kick', event)
 
+        # Pruned members are still part of the snapshot
+        self._snapshots.pop(guild.id, None)
+
         await ctx.send(f'Successfully pruned `{count}` members.')
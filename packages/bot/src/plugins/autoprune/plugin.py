@@ -18,14 +18,18 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import datetime
+import itertools
 import logging
+import time
 import typing
 
 import discord
 from discord.ext import tasks
 
 from ... import InfractionEvent, NotFound, Plugin
+from ...utils import create_task
 from .enums import ActivityType
 
 
@@ -34,6 +38,35 @@ log = logging.getLogger(__name__)
 # Moderator permissions - ignore these users unconditionally
 PERMISSIONS = discord.Permissions(administrator=True, ban_members=True, kick_members=True, manage_messages=True)
 
+# Amount of kick requests made at once
+KICK_CONCURRENCY = 5
+
+# Every guild is pruned once per interval, at a time derived from its ID
+PRUNE_INTERVAL = 86400
+# How often guilds are checked for whether they are due
+PRUNE_CHECK_INTERVAL = 600
+
+# Amount of guilds pruned at once
+PRUNE_CONCURRENCY = 2
+# Progress is saved in redis after kicking this many members
+CHECKPOINT_SIZE = 100
+
+
+def is_candidate(member, me):
+    if member.bot or member.top_role >= me.top_role:
+        return False
+
+    # Moderators are never pruned
+    return member.guild_permissions.value & PERMISSIONS.value == 0
+
+
+def prune_slot(guild_id, now):
+    """Returns the most recent time a guild was scheduled to be pruned at, as a UNIX timestamp."""
+
+    # The creation time of guilds is spread well enough to stagger them
+    offset = (guild_id >> 22) % PRUNE_INTERVAL
+    return now - (now - offset) % PRUNE_INTERVAL
+
 
 def has_no_roles(member):
     return len(member.roles) == 1
@@ -50,7 +83,7 @@ def joined_before(config):
     now = discord.utils.utcnow()
     timeout = config.inactive_timeout.total_seconds()
 
-    async def check(member):
+    def check(member, status):
         if member.joined_at is None:
             return False
 
@@ -59,15 +92,11 @@ def joined_before(config):
     return check
 
 
-def seen_before(config, mousey):
+def seen_before(config):
     now = datetime.datetime.utcnow()
     timeout = config.inactive_timeout.total_seconds()
 
-    tracking = mousey.get_cog('Tracking')
-
-    async def check(member):
-        status = await tracking.get_last_status(member)
-
+    def check(member, status):
         # Default to rule setup date
         # To allow pruning members never seen
         return (now - (status.seen or config.updated_at)).total_seconds() >= timeout
@@ -75,15 +104,11 @@ def seen_before(config, mousey):
     return check
 
 
-def status_before(config, mousey):
+def status_before(config):
     now = datetime.datetime.utcnow()
     timeout = config.inactive_timeout.total_seconds()
 
-    tracking = mousey.get_cog('Tracking')
-
-    async def check(member):
-        status = await tracking.get_last_status(member)
-
+    def check(member, status):
         # Default to rule setup date
         # To allow pruning members never online or seen
         seen = (status.status, status.seen, config.updated_at)
@@ -106,12 +131,19 @@ class AutoPrune(Plugin):
     def __init__(self, mousey):
         super().__init__(mousey)
 
+        self._semaphore = asyncio.Semaphore(PRUNE_CONCURRENCY)
+        # Guild ID -> task
+        self._running = {}
+
         self.do_prune.start()
 
     def cog_unload(self):
         self.do_prune.stop()
 
-    @tasks.loop(hours=24)
+        for task in self._running.values():
+            task.cancel()
+
+    @tasks.loop(seconds=PRUNE_CHECK_INTERVAL)
     async def do_prune(self):
         await self.mousey.wait_until_ready()
 
@@ -120,6 +152,8 @@ class AutoPrune(Plugin):
         except NotFound:
             return
 
+        configs = []
+
         for data in resp:
             data['activity_type'] = ActivityType(data['activity_type'])
 
@@ -127,9 +161,59 @@ class AutoPrune(Plugin):
             data['inactive_timeout'] = datetime.timedelta(seconds=data['inactive_timeout'])
 
             config = PruneConfig(**data)
-            await self._do_guild_prune(config)
 
-    async def _do_guild_prune(self, config):
+            if config.guild_id not in self._running:
+                configs.append(config)
+
+        if not configs:
+            return
+
+        now = int(time.time())
+
+        async with await self.mousey.redis.pipeline(transaction=False) as pipe:
+            for config in configs:
+                await pipe.hgetall(f'mousey:autoprune:{config.guild_id}')
+
+            checkpoints = await pipe.execute()
+
+        for config, checkpoint in zip(configs, checkpoints):
+            guild_id = config.guild_id
+            slot = prune_slot(guild_id, now)
+
+            # Newly configured guilds are first pruned at their next slot
+            if not checkpoint:
+                await self._save_checkpoint(guild_id, finished_at=slot)
+                continue
+
+            if int(checkpoint.get(b'finished_at', 0)) >= slot:
+                continue
+
+            # Resume from the last checkpoint if the previous attempt was interrupted
+            if int(checkpoint.get(b'slot', 0)) == slot:
+                after_id = int(checkpoint[b'member_id'])
+            else:
+                after_id = 0
+
+            task = create_task(self._run_guild_prune(config, slot, after_id))
+
+            self._running[guild_id] = task
+            task.add_done_callback(lambda _, guild_id=guild_id: self._running.pop(guild_id, None))
+
+    async def _run_guild_prune(self, config, slot, after_id):
+        async with self._semaphore:
+            await self._do_guild_prune(config, slot, after_id)
+            await self._save_checkpoint(config.guild_id, finished_at=slot)
+
+    async def _save_checkpoint(self, guild_id, **fields):
+        key = f'mousey:autoprune:{guild_id}'
+
+        async with await self.mousey.redis.pipeline(transaction=False) as pipe:
+            await pipe.hmset(key, fields)
+            await pipe.expire(key, PRUNE_INTERVAL * 7)
+
+            await pipe.execute()
+
+    async def _do_guild_prune(self, config, slot, after_id):
         guild = self.mousey.get_guild(config.guild_id)
 
         if guild is None:
@@ -144,35 +228,86 @@ class AutoPrune(Plugin):
         if not config.role_ids:
             role_check = has_no_roles
         else:
-            role_check = has_any_role(config.role_ids)
+            role_check = has_any_role(set(config.role_ids))
 
         if config.activity_type is ActivityType.joined:
             activity_check = joined_before(config)
         elif config.activity_type is ActivityType.seen:
-            activity_check = seen_before(config, self.mousey)
+            activity_check = seen_before(config)
         else:
-            activity_check = status_before(config, self.mousey)
+            activity_check = status_before(config)
 
         me = guild.me
+        timings = {}
+
+        started_at = time.perf_counter()
+
+        def finish_phase(name):
+            nonlocal started_at
+
+            now = time.perf_counter()
+            timings[name] = now - started_at
+
+            started_at = now
+
+        # Members are processed in order of their ID to allow resuming
+        remaining = sorted((x for x in guild.members if x.id > after_id), key=lambda x: x.id)
+
+        candidates = [x for x in remaining if is_candidate(x, me) and role_check(x)]
+        finish_phase('filter')
+
+        if config.activity_type is ActivityType.joined or not candidates:
+            statuses = itertools.repeat(None)
+        else:
+            statuses = await self.mousey.get_cog('Tracking').bulk_last_status(*candidates)
+
+        finish_phase('lookup')
+
+        members = [member for member, status in zip(candidates, statuses) if activity_check(member, status)]
+        finish_phase('evaluate')
+
+        kicked = 0
+
+        selected = set(members)
+        batch = []
+
+        # Checkpoints record the last evaluated member, to not evaluate members which were not kicked again either
+        for index, member in enumerate(remaining):
+            if member in selected:
+                batch.append(member)
+
+            if len(batch) == CHECKPOINT_SIZE or index == len(remaining) - 1:
+                kicked += await self._kick_members(guild, batch)
+                await self._save_checkpoint(guild.id, slot=slot, member_id=member.id)
+
+                batch = []
+
+        finish_phase('kick')
+
+        timings = ', '.join(f'{name} {duration:.2f}s' for name, duration in timings.items())
+        log.info(f'Pruned {kicked}/{len(members)} of {len(guild.members)} members in guild {guild.id} ({timings}).')
+
+    async def _kick_members(self, guild, members):
+        me = guild.me
 
         events = self.mousey.get_cog('Events')
         reason = 'Automatic prune due to inactivity'
 
-        for member in guild.members:
-            if member.bot or member.top_role >= me.top_role:
-                continue
+        # Kicks share a rate limit bucket per guild, which is respected by the HTTP client
+        semaphore = asyncio.Semaphore(KICK_CONCURRENCY)
 
-            permissions = member.guild_permissions
-            if permissions.value & PERMISSIONS.value != 0:  # Mod
-                continue
-
-            if role_check(member) and await activity_check(member):
+        async def kick(member):
+            async with semaphore:
                 event = InfractionEvent(guild, member, me, reason)
                 events.ignore(guild, 'mouse_member_kick', event)
 
                 try:
                     await member.kick(reason=reason)
                 except discord.HTTPException:
-                    pass
-                else:
-                    self.mousey.dispatch('mouse_member_kick', event)
+                    return False
+
+            self.mousey.dispatch('mouse_member_kick', event)
+            return True
+
+        results = await asyncio.gather(*map(kick, members))
+        return sum(results)
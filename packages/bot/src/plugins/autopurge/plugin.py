@@ -18,18 +18,37 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import datetime
+import heapq
+import time
 import typing
 
 import discord
+import more_itertools
 from discord.ext import tasks
 
 from ... import NotFound, Plugin
+from ...utils import create_task
 
 
 # Permissions required to purge messages in a channel
 PERMISSIONS = discord.Permissions(view_channel=True, manage_messages=True, read_message_history=True)
 
+# Messages older than this have to be deleted one by one
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14, minutes=-5)
+BULK_DELETE_SIZE = 100
+
+# Channels without a checkpoint are scanned on Discord entirely
+CHECKPOINT_TTL = 86400 * 7
+
+# Channels are purged once their oldest message expires, but not more often than the minimum interval
+PURGE_MIN_INTERVAL = 60
+PURGE_MAX_INTERVAL = 3600
+
+# Amount of channels purged at once, channels of one guild are purged one after another
+PURGE_CONCURRENCY = 5
+
 
 def is_not_pinned(message):
     return not message.pinned
@@ -40,30 +59,99 @@ class PurgeConfig(typing.NamedTuple):
     max_age: datetime.timedelta
 
 
-# TODO: Delete messages on time when interval is small
 class AutoPurge(Plugin):
     def __init__(self, mousey):
         super().__init__(mousey)
 
-        self.do_purge.start()
+        # Channel ID -> config
+        self._configs = {}
+        # Heap of purge deadline, channel ID, entries of removed configs are skipped
+        self._queue = []
+        # Channel IDs currently being purged
+        self._purging = set()
+
+        self._semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+        # Guild ID -> lock
+        self._guild_locks = {}
+
+        self._wake = asyncio.Event()
+        self._task = create_task(self._run_purges())
+
+        self.update_configs.start()
 
     def cog_unload(self):
-        self.do_purge.stop()
+        self.update_configs.stop()
+
+        if not self._task.done():
+            self._task.cancel()
 
     @tasks.loop(hours=1)
-    async def do_purge(self):
+    async def update_configs(self):
         await self.mousey.wait_until_ready()
 
         try:
             resp = await self.mousey.api.get_autopurge(self.mousey.shard_id)
         except NotFound:
-            return
+            resp = []
+
+        configs = {}
 
         for config in resp:
             config['max_age'] = datetime.timedelta(seconds=config['max_age'])
 
             config = PurgeConfig(**config)
-            await self._do_channel_purge(config)
+            configs[config.channel_id] = config
+
+        # Newly configured channels are purged right away
+        for channel_id in configs.keys() - self._configs.keys():
+            self._schedule_purge(channel_id, time.time())
+
+        self._configs = configs
+
+    def _schedule_purge(self, channel_id, deadline):
+        heapq.heappush(self._queue, (deadline, channel_id))
+        self._wake.set()
+
+    async def _run_purges(self):
+        while True:
+            now = time.time()
+
+            while self._queue and self._queue[0][0] <= now:
+                _, channel_id = heapq.heappop(self._queue)
+
+                if channel_id in self._configs and channel_id not in self._purging:
+                    self._purging.add(channel_id)
+                    create_task(self._purge_channel(self._configs[channel_id]))
+
+            timeout = self._queue[0][0] - now if self._queue else None
+            self._wake.clear()
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purge_channel(self, config):
+        channel = self.mousey.get_channel(config.channel_id)
+        deadline = None
+
+        try:
+            if channel is not None:
+                lock = self._guild_locks.setdefault(channel.guild.id, asyncio.Lock())
+
+                async with lock, self._semaphore:
+                    deadline = await self._do_channel_purge(config)
+        finally:
+            self._purging.discard(config.channel_id)
+
+            now = time.time()
+
+            if deadline is None:
+                deadline = now + PURGE_MAX_INTERVAL
+
+            # Channels are still purged regularly to scan for messages which were not recorded
+            deadline = min(max(deadline, now + PURGE_MIN_INTERVAL), now + PURGE_MAX_INTERVAL)
+            self._schedule_purge(config.channel_id, deadline)
 
     async def _do_channel_purge(self, config):
         channel = self.mousey.get_channel(config.channel_id)
@@ -74,5 +162,63 @@ class AutoPurge(Plugin):
         if not channel.permissions_for(channel.guild.me).is_superset(PERMISSIONS):
             return
 
+        redis = self.mousey.redis
+        messages = self.mousey.get_cog('Messages')
+
         before = discord.utils.utcnow() - config.max_age
-        await channel.purge(before=before, check=is_not_pinned, limit=None)
+        indexed_since = messages.indexed_since
+
+        # Messages before this were already purged
+        checkpoint = await redis.get(f'mousey:autopurge:{channel.id}')
+        after = None if checkpoint is None else discord.utils.snowflake_time(int(checkpoint))
+
+        # Messages sent while not being recorded can only be found on Discord
+        if after is None or after < indexed_since:
+            scan_before = min(before, indexed_since)
+
+            await channel.purge(before=scan_before, after=after, check=is_not_pinned, limit=None)
+            after = scan_before
+
+        if after < before:
+            message_ids = await messages.get_message_ids(
+                channel.id,
+                before=discord.utils.time_snowflake(before),
+                after=discord.utils.time_snowflake(after) - 1,
+            )
+
+            if message_ids:
+                pinned = set(x.id for x in await channel.pins())
+                await self._delete_messages(channel, [x for x in message_ids if x not in pinned])
+
+        checkpoint = discord.utils.time_snowflake(before)
+        await redis.set(f'mousey:autopurge:{channel.id}', checkpoint, ex=CHECKPOINT_TTL)
+
+        # The next purge is due once the oldest remaining message expires
+        oldest_id = await messages.get_oldest_message_id(channel.id, after=checkpoint - 1)
+
+        if oldest_id is None:
+            return time.time() + config.max_age.total_seconds()
+
+        return (discord.utils.snowflake_time(oldest_id) + config.max_age).timestamp()
+
+    async def _delete_messages(self, channel, message_ids):
+        bulk_after = discord.utils.time_snowflake(discord.utils.utcnow() - BULK_DELETE_MAX_AGE)
+
+        old = [x for x in message_ids if x < bulk_after]
+        recent = [x for x in message_ids if x >= bulk_after]
+
+        for chunk in more_itertools.chunked(recent, BULK_DELETE_SIZE):
+            if len(chunk) == 1:  # Bulk deletes require at least two messages
+                old.extend(chunk)
+            else:
+                try:
+                    await self.mousey.http.delete_messages(channel.id, chunk)
+                except discord.HTTPException:
+                    # Bulk deletes fail entirely if any message was deleted already or became too old
+                    old.extend(chunk)
+
+        for message_id in old:
+            try:
+                await self.mousey.http.delete_message(channel.id, message_id)
+            except discord.NotFound:
+                pass
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+
+
+def estimate_size(message):
+    """Approximate memory used by a decrypted message dict, in bytes."""
+
+    # Base cost of the dict and its scalar values, plus roughly one byte per character stored
+    size = 400 + len(message['content'])
+
+    size += sum(200 + len(x) for x in message['attachments'])
+    size += sum(1000 + len(str(x)) for x in message['embeds'])
+
+    return size
+
+
+class MessageCache:
+    """
+    LRU cache of recently seen decrypted messages.
+
+    Parameters
+    ----------
+    max_size: int
+        The maximum amount of messages to keep in total.
+    max_bytes: int
+        The approximate amount of memory the cached messages may use.
+    max_channel_size: int
+        The maximum amount of messages to keep per channel.
+    """
+
+    def __init__(self, max_size, max_bytes, max_channel_size):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_channel_size = max_channel_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.bytes = 0
+
+        # Message ID -> (message, size)
+        self._messages = collections.OrderedDict()
+        # Channel ID -> message IDs in LRU order
+        self._channels = collections.defaultdict(collections.OrderedDict)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __repr__(self):
+        return f'<MessageCache size={len(self)} bytes={self.bytes} hits={self.hits} misses={self.misses}>'
+
+    def get(self, message_id):
+        try:
+            message, _ = self._messages[message_id]
+        except KeyError:
+            self.misses += 1
+            return
+
+        self.hits += 1
+        self._touch(message)
+
+        return message
+
+    def put(self, message):
+        message_id = message['id']
+        size = estimate_size(message)
+
+        try:
+            _, old_size = self._messages[message_id]
+        except KeyError:
+            pass
+        else:
+            self.bytes -= old_size
+
+        self.bytes += size
+        self._messages[message_id] = (message, size)
+
+        self._touch(message)
+        self._evict(message['channel_id'])
+
+    def remove(self, message_id):
+        try:
+            message, size = self._messages.pop(message_id)
+        except KeyError:
+            return
+
+        self.bytes -= size
+        self._remove_from_channel(message)
+
+    def remove_before(self, message_id):
+        """Remove all messages older than the given message ID."""
+
+        for old_id in [x for x in self._messages if x < message_id]:
+            self.remove(old_id)
+
+    def clear(self):
+        self.bytes = 0
+
+        self._messages.clear()
+        self._channels.clear()
+
+    def _touch(self, message):
+        message_id = message['id']
+
+        self._messages.move_to_end(message_id)
+
+        channel = self._channels[message['channel_id']]
+        channel[message_id] = None
+        channel.move_to_end(message_id)
+
+    def _evict(self, channel_id):
+        channel = self._channels[channel_id]
+
+        while len(channel) > self.max_channel_size:
+            message_id = next(iter(channel))
+            self._evict_message(message_id)
+
+        while self._messages and (len(self._messages) > self.max_size or self.bytes > self.max_bytes):
+            message_id = next(iter(self._messages))
+            self._evict_message(message_id)
+
+    def _evict_message(self, message_id):
+        self.evictions += 1
+        self.remove(message_id)
+
+    def _remove_from_channel(self, message):
+        channel_id = message['channel_id']
+        channel = self._channels[channel_id]
+
+        channel.pop(message['id'], None)
+
+        if not channel:
+            del self._channels[channel_id]
+
+
+class LRUCache:
+    """
+    Mapping which discards the least recently used entries once full.
+
+    Parameters
+    ----------
+    max_size: int
+        The maximum amount of entries to keep.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return
+
+        self.hits += 1
+        self._items.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
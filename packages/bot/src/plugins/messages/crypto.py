@@ -18,6 +18,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import base64
+import hashlib
 import json
 
 import cryptography.fernet
@@ -27,6 +29,9 @@ from ... import FERNET_KEY
 
 _FERNET = cryptography.fernet.Fernet(FERNET_KEY)
 
+# Prefixed to encrypted payloads to allow changing the format later
+PAYLOAD_VERSION = 1
+
 
 def encrypt(data):
     return _FERNET.encrypt(data.encode('utf-8'))
@@ -42,3 +47,47 @@ def encrypt_json(data):
 
 def decrypt_json(data):
     return json.loads(decrypt(data))
+
+
+def hash_json(data):
+    """Create a keyed 64 bit hash of a JSON-serializable object, usable as a BIGINT."""
+
+    data = json.dumps(data, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    digest = hashlib.blake2b(data, digest_size=8, key=FERNET_KEY.encode('utf-8')).digest()
+
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def encrypt_payload(data):
+    """Encrypt a JSON-serializable object into a versioned binary payload."""
+
+    token = _FERNET.encrypt(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    # Tokens are stored decoded instead of as base64 to save space
+    return bytes([PAYLOAD_VERSION]) + base64.urlsafe_b64decode(token)
+
+
+def decrypt_payload(data):
+    """Decrypt a payload created using encrypt_payload."""
+
+    version = data[0]
+
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f'Unknown payload version {version}.')
+
+    token = base64.urlsafe_b64encode(data[1:])
+    return json.loads(_FERNET.decrypt(token).decode('utf-8'))
+
+
+def decrypt_fields(data):
+    """Decrypt the content, embeds, and attachments of a message fetched from the database."""
+
+    if data['data'] is not None:
+        return decrypt_payload(data['data'])
+
+    # Legacy format with every field encrypted separately
+    content = decrypt(data['content'])
+    embeds = list(map(decrypt_json, data['embeds']))
+    attachments = list(map(decrypt, data['attachments']))
+
+    return content, embeds, attachments
@@ -23,6 +23,11 @@ import re
 import discord
 
 from ...utils import populate_methods
+from .crypto import decrypt_fields
+
+
+ATTACHMENT_PATH_RE = re.compile(r'/attachments/(\d{15,21})/(\d{15,21})/(.+)')
+USER_MENTION_RE = re.compile(r'<@!?(\d{15,21})>')
 
 
 @populate_methods(discord.Attachment)
@@ -30,7 +35,7 @@ class Attachment:
     __slots__ = ('_http', 'channel_id', 'filename', 'id')
 
     def __init__(self, path, state):
-        match = re.match(r'/attachments/(\d{15,21})/(\d{15,21})/(.+)', path)
+        match = ATTACHMENT_PATH_RE.match(path)
 
         self.channel_id = int(match.group(1))
 
@@ -50,7 +55,19 @@ class Attachment:
 
 @populate_methods(discord.Message)
 class Message:
-    __slots__ = ('attachments', 'author', 'channel', 'content', 'deleted_at', 'edited_at', 'embeds', 'id')
+    __slots__ = (
+        '_attachment_paths',
+        '_attachments',
+        '_content',
+        '_embed_data',
+        '_embeds',
+        '_encrypted',
+        'author',
+        'channel',
+        'deleted_at',
+        'edited_at',
+        'id',
+    )
 
     def __init__(self, **kwargs):
         self.id = kwargs['id']
@@ -58,10 +75,11 @@ class Message:
         self.author = kwargs['author']
         self.channel = kwargs['channel']
 
-        self.content = kwargs['content']
+        # Messages fetched from the database may be decrypted on first access
+        self._encrypted = kwargs.get('encrypted')
 
-        self.embeds = list(map(discord.Embed.from_dict, kwargs['embeds']))
-        self.attachments = [Attachment(path=x, state=self._state) for x in kwargs['attachments']]
+        if self._encrypted is None:
+            self._load(kwargs['content'], kwargs['embeds'], kwargs['attachments'])
 
         self.edited_at = kwargs['edited_at']
         self.deleted_at = kwargs['deleted_at']
@@ -72,9 +90,49 @@ class Message:
     @property
     def user_mentions(self):
         # Note that this doesn't respect allowed_mentions on the message
-        matches = re.findall(r'<@!?(\d{15,21})>', self.content)
+        matches = USER_MENTION_RE.findall(self.content)
         return filter(None, map(self.guild.get_member, map(int, matches)))
 
+    @property
+    def content(self):
+        self._decrypt()
+        return self._content
+
+    @property
+    def embeds(self):
+        self._decrypt()
+
+        if self._embeds is None:
+            self._embeds = list(map(discord.Embed.from_dict, self._embed_data))
+            self._embed_data = None
+
+        return self._embeds
+
+    @property
+    def attachments(self):
+        self._decrypt()
+
+        if self._attachments is None:
+            self._attachments = [Attachment(path=x, state=self._state) for x in self._attachment_paths]
+            self._attachment_paths = None
+
+        return self._attachments
+
+    def _load(self, content, embeds, attachments):
+        self._content = content
+
+        # Embeds and attachments are only built once accessed
+        self._embeds = None
+        self._embed_data = embeds
+
+        self._attachments = None
+        self._attachment_paths = attachments
+
+    def _decrypt(self):
+        if self._encrypted is not None:
+            self._load(*decrypt_fields(self._encrypted))
+            self._encrypted = None
+
     # Properties don't get copied with @populate_methods
 
     @property
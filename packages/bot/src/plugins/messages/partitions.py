@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import datetime
+import re
+
+import discord
+
+
+# Serializes partition changes across shards
+PARTITION_LOCK_ID = 0x6D6F757365
+
+_UPPER_BOUND = re.compile(r"TO \('?(-?\d+)'?\)")
+_RANGE_BOUNDS = re.compile(r"FROM \('?(-?\d+|MINVALUE)'?\) TO \('?(-?\d+|MAXVALUE)'?\)")
+
+# Used in place of MINVALUE and MAXVALUE, outside of the BIGINT range
+_MIN_BOUND = -(2 ** 63) - 1
+_MAX_BOUND = 2 ** 63
+
+
+def partition_name(day):
+    return f'messages_{day:%Y%m%d}'
+
+
+def partition_range(day):
+    """Returns the snowflake range of messages sent on a day, excluding the upper bound."""
+
+    lower = discord.utils.time_snowflake(day)
+    upper = discord.utils.time_snowflake(day + datetime.timedelta(days=1))
+
+    return lower, upper
+
+
+async def get_partitions(conn):
+    """Returns a mapping of names of bounded partitions to their exclusive upper bound."""
+
+    records = await _fetch_bounds(conn)
+
+    # Default partitions have no bounds
+    return {x['name']: int(match.group(1)) for x in records if (match := _UPPER_BOUND.search(x['bound']))}
+
+
+async def get_partition_ranges(conn):
+    """Returns the sorted ID ranges of partitions excluding the upper bound, None if a default partition exists."""
+
+    ranges = []
+
+    for record in await _fetch_bounds(conn):
+        match = _RANGE_BOUNDS.search(record['bound'])
+
+        if match is None:  # Default partitions hold every ID
+            return
+
+        lower, upper = match.groups()
+        ranges.append(
+            (_MIN_BOUND if lower == 'MINVALUE' else int(lower), _MAX_BOUND if upper == 'MAXVALUE' else int(upper))
+        )
+
+    return sorted(ranges)
+
+
+def is_partitioned(ranges, message_id):
+    """Whether a message can be stored in the partitions returned by get_partition_ranges."""
+
+    if ranges is None:
+        return True
+
+    index = bisect.bisect_right(ranges, (message_id, _MAX_BOUND)) - 1
+    return index >= 0 and message_id < ranges[index][1]
+
+
+async def _fetch_bounds(conn):
+    return await conn.fetch(
+        """
+        SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'messages'::regclass
+        """
+    )
@@ -21,20 +21,79 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
 import datetime
 import itertools
+import logging
+import pathlib
+import time
 
 import aiohttp
+import asyncpg
 import discord
 import more_itertools
 from discord.ext import tasks
 
-from ... import BulkMessageDeleteEvent, HTTPException, MessageDeleteEvent, MessageEditEvent, Plugin
-from ...utils import PGSQL_ARG_LIMIT, multirow_insert, serialize_user
-from .crypto import decrypt, decrypt_json, encrypt, encrypt_json
+from ... import JOURNAL_PATH, BulkMessageDeleteEvent, HTTPException, MessageDeleteEvent, MessageEditEvent, Plugin
+from ...utils import PGSQL_ARG_LIMIT, FlushScheduler, Journal, multirow_insert, serialize_user
+from .cache import LRUCache, MessageCache, estimate_size
+from .crypto import decrypt_fields, decrypt_json, encrypt_json, encrypt_payload, hash_json
 from .errors import InvalidMessage
 from .message import Message
+from .partitions import (
+    PARTITION_LOCK_ID,
+    get_partition_ranges,
+    get_partitions,
+    is_partitioned,
+    partition_name,
+    partition_range,
+)
 from .utils import attachment_paths, serialize_datetime
 
 
+log = logging.getLogger(__name__)
+
+# Pending messages are written to a local journal frequently,
+# Which allows writing them to the database less often
+JOURNAL_INTERVAL = 0.25
+
+# Pending messages are persisted once any of these limits is reached
+FLUSH_INTERVAL = 5
+FLUSH_MAX_ITEMS = 10_000
+FLUSH_MAX_BYTES = 16 * 1024 * 1024
+
+# Flushes taking longer than this make the limits above grow temporarily
+SLOW_FLUSH_DURATION = 1
+
+# Batches at least this large are streamed into a staging table using COPY
+# Smaller batches are cheaper to send as a single multirow INSERT statement
+COPY_THRESHOLD = 500
+
+# Recently seen messages are kept decrypted in memory for edit and delete events
+CACHE_MAX_SIZE = 100_000
+CACHE_MAX_BYTES = 128 * 1024 * 1024
+CACHE_MAX_CHANNEL_SIZE = 2_000
+
+# Webhook authors are stored once, and marked as used in the database at most once per interval
+AUTHOR_CACHE_SIZE = 10_000
+AUTHOR_REFRESH_INTERVAL = 86400
+
+# Amount of messages fetched at once when iterating over channel history
+HISTORY_PAGE_SIZE = 100
+
+# Rows still using the legacy format are rewritten in batches of this size
+MIGRATION_BATCH_SIZE = 1_000
+# Set once no rows using the legacy format are left, shards skip the migration afterwards
+MIGRATED_KEY = 'mousey:messages-migrated'
+
+# Messages are stored in daily partitions, which are dropped once all messages in them expired
+RETENTION = datetime.timedelta(days=30)
+PARTITIONS_AHEAD = 3
+
+MESSAGE_COLUMNS = ('id', 'author_id', 'channel_id', 'data', 'edited_at', 'deleted_at', 'webhook_author_id')
+# Columns selected when fetching messages, which may still use the legacy format
+SELECT_COLUMNS = (
+    'id, author_id, channel_id, data, content, embeds, attachments, edited_at, deleted_at, webhook_author_id'
+)
+
+
 def encrypt_message(message):
     """Prepare for a message to be stored."""
 
@@ -43,11 +102,10 @@ def encrypt_message(message):
         message['id'],
         message['author_id'],
         message['channel_id'],
-        encrypt(message['content']),
-        list(map(encrypt_json, message['embeds'])),
-        list(map(encrypt, message['attachments'])),
+        encrypt_payload([message['content'], message['embeds'], message['attachments']]),
         message['edited_at'],
         message['deleted_at'],
+        message['webhook_author_id'],
     ]
 
     return data
@@ -56,20 +114,57 @@ def encrypt_message(message):
 def decrypt_message(data):
     """Decrypt a message fetched from the database."""
 
+    content, embeds, attachments = decrypt_fields(data)
+
+    message = {
+        'id': data['id'],
+        'author_id': data['author_id'],
+        'channel_id': data['channel_id'],
+        'content': content,
+        'embeds': embeds,
+        'attachments': attachments,
+        'edited_at': data['edited_at'],
+        'deleted_at': data['deleted_at'],
+        'webhook_author_id': data['webhook_author_id'],
+    }
+
+    return message
+
+
+def lazy_message(data):
+    """Prepare a message fetched from the database to be decrypted once its content is accessed."""
+
     message = {
         'id': data['id'],
         'author_id': data['author_id'],
         'channel_id': data['channel_id'],
-        'content': decrypt(data['content']),
-        'embeds': list(map(decrypt_json, data['embeds'])),
-        'attachments': list(map(decrypt, data['attachments'])),
+        'encrypted': data,
         'edited_at': data['edited_at'],
         'deleted_at': data['deleted_at'],
+        'webhook_author_id': data['webhook_author_id'],
     }
 
     return message
 
 
+async def encrypt_messages(messages):
+    """Encrypt a batch of messages in a worker thread."""
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _map_list, encrypt_message, messages)
+
+
+async def decrypt_messages(records):
+    """Decrypt a batch of database records in a worker thread."""
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _map_list, decrypt_message, records)
+
+
+def _map_list(func, items):
+    return list(map(func, items))
+
+
 class Messages(Plugin):
     def __init__(self, mousey):
         super().__init__(mousey)
@@ -77,11 +172,52 @@ class Messages(Plugin):
         self._messages = {}
         self._updating = {}
 
-        self.persist_messages.start()
+        # Messages sent before connecting were not recorded
+        self._connected_at = discord.utils.utcnow()
+
+        self._journal = None
+        self._segments = []
+
+        # Messages not written to the journal yet
+        self._unjournaled = {}
+        # Encrypted rows of journaled messages
+        self._journaled = {}
+        # Encrypted rows currently being written to the database
+        self._persisting = {}
+
+        self._journal_lock = asyncio.Lock()
+        self._journal_scheduler = FlushScheduler(JOURNAL_INTERVAL)
+
+        self.scheduler = FlushScheduler(
+            FLUSH_INTERVAL,
+            name='message',
+            max_items=FLUSH_MAX_ITEMS,
+            max_bytes=FLUSH_MAX_BYTES,
+            slow_duration=SLOW_FLUSH_DURATION,
+        )
+
+        self.cache = MessageCache(CACHE_MAX_SIZE, CACHE_MAX_BYTES, CACHE_MAX_CHANNEL_SIZE)
+
+        # Webhook author ID -> discord.User
+        self._authors = LRUCache(AUTHOR_CACHE_SIZE)
+        # Webhook author ID -> time last stored
+        self._stored_authors = LRUCache(AUTHOR_CACHE_SIZE)
+
+        self._migrated_id = 0
+        self._migrated = False
+
+        self.journal_messages.start()
+        self.migrate_messages.start()
         self.delete_old_messages.start()
 
     def cog_unload(self):
+        self.journal_messages.stop()
+        self._journal_scheduler.close()
+
         self.persist_messages.stop()
+        self.scheduler.close()
+
+        self.migrate_messages.cancel()
         self.delete_old_messages.stop()
 
     async def get_message(self, message_id):
@@ -90,6 +226,10 @@ class Messages(Plugin):
         if data is not None:
             return await self._create_message(data)
 
+    async def get_messages_by_ids(self, message_ids):
+        messages = await self._get_messages(message_ids)
+        return await self._create_messages(messages)
+
     async def get_messages(self, channel, before=None, limit=100):
         if before is None:
             now = discord.utils.utcnow()
@@ -99,8 +239,8 @@ class Messages(Plugin):
 
         async with self.mousey.db.acquire() as conn:
             records = await conn.fetch(
-                """
-                SELECT id, author_id, channel_id, content, embeds, attachments, edited_at, deleted_at
+                f"""
+                SELECT {SELECT_COLUMNS}
                 FROM messages
                 WHERE channel_id = $1 AND id < $2
                 ORDER BY id DESC
@@ -111,9 +251,121 @@ class Messages(Plugin):
                 limit,
             )
 
-        messages = map(decrypt_message, records)
+        messages = await decrypt_messages(records)
         return [await self._create_message(x) for x in messages]
 
+    async def iter_history(self, channel, *, before=None, after=None):
+        """
+        Iterate over stored messages in a channel, newest first.
+
+        The next page of messages is fetched while the current one is being processed,
+        message content is only decrypted once it is accessed.
+        """
+
+        if before is None:
+            now = discord.utils.utcnow()
+            before = discord.utils.time_snowflake(now)
+        elif isinstance(before, datetime.datetime):
+            before = discord.utils.time_snowflake(before)
+
+        if after is None:
+            after = 0
+        elif isinstance(after, datetime.datetime):
+            after = discord.utils.time_snowflake(after, high=True)
+
+        task = asyncio.create_task(self._fetch_history(channel.id, before, after))
+
+        try:
+            while task is not None:
+                records = await task
+
+                if len(records) < HISTORY_PAGE_SIZE:
+                    task = None
+                else:
+                    task = asyncio.create_task(self._fetch_history(channel.id, records[-1]['id'], after))
+
+                messages = []
+
+                for record in records:
+                    # Pending updates are newer than the stored version
+                    pending = self._messages.get(record['id']) or self._updating.get(record['id'])
+                    messages.append(pending or lazy_message(record))
+
+                for message in await self._create_messages(messages):
+                    yield message
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def _fetch_history(self, channel_id, before, after):
+        async with self.mousey.db.acquire() as conn:
+            return await conn.fetch(
+                f"""
+                SELECT {SELECT_COLUMNS}
+                FROM messages
+                WHERE channel_id = $1 AND id < $2 AND id > $3
+                ORDER BY id DESC
+                LIMIT $4
+                """,
+                channel_id,
+                before,
+                after,
+                HISTORY_PAGE_SIZE,
+            )
+
+    @property
+    def indexed_since(self):
+        """Every message sent in a channel after this has been recorded."""
+
+        return max(self._connected_at, discord.utils.utcnow() - RETENTION)
+
+    async def get_message_ids(self, channel_id, *, before, after):
+        """Returns the IDs of stored messages in a channel which have not been deleted, oldest first."""
+
+        async with self.mousey.db.acquire() as conn:
+            records = await conn.fetch(
+                """
+                SELECT id
+                FROM messages
+                WHERE channel_id = $1 AND id < $2 AND id > $3 AND deleted_at IS NULL
+                ORDER BY id ASC
+                """,
+                channel_id,
+                before,
+                after,
+            )
+
+        message_ids = set(x['id'] for x in records)
+
+        # Pending updates are newer than the stored version
+        for pending in (self._updating, self._messages):
+            for message in pending.values():
+                if message['channel_id'] != channel_id or not after < message['id'] < before:
+                    continue
+
+                if message['deleted_at'] is None:
+                    message_ids.add(message['id'])
+                else:
+                    message_ids.discard(message['id'])
+
+        return sorted(message_ids)
+
+    async def get_oldest_message_id(self, channel_id, *, after):
+        """Returns the ID of the oldest stored message in a channel which has not been deleted."""
+
+        async with self.mousey.db.acquire() as conn:
+            return await conn.fetchval(
+                """
+                SELECT id
+                FROM messages
+                WHERE channel_id = $1 AND id > $2 AND deleted_at IS NULL
+                ORDER BY id ASC
+                LIMIT 1
+                """,
+                channel_id,
+                after,
+            )
+
     async def create_archive(self, messages):
         archived = []
         guild_id = messages[0].guild.id
@@ -142,9 +394,19 @@ class Messages(Plugin):
 
         return 'https://dash.mousey.app/archives/' + str(data['id'])  # No local URLs for now
 
+    @Plugin.listener()
+    async def on_ready(self):
+        # Events are only replayed when resuming, not when reconnecting
+        self._connected_at = discord.utils.utcnow()
+
     @Plugin.listener()
     async def on_message(self, message):
-        author_id = None if message.webhook_id else message.author.id
+        if message.webhook_id is None:
+            author_id = message.author.id
+            webhook_author_id = webhook_author = None
+        else:
+            author_id = None
+            webhook_author_id, webhook_author = self._intern_author(message.author)
 
         embeds = list(x.to_dict() for x in message.embeds)
         attachments = attachment_paths(message.attachments)
@@ -159,11 +421,12 @@ class Messages(Plugin):
                 attachments=attachments,
                 edited_at=None,
                 deleted_at=None,
+                webhook_author_id=webhook_author_id,
             )
         )
 
-        if message.webhook_id is not None:
-            await self._set_author(message.id, message.author)
+        if webhook_author is not None:
+            await self._store_author(webhook_author_id, webhook_author)
 
     @Plugin.listener()
     async def on_raw_message_edit(self, payload):
@@ -213,17 +476,11 @@ class Messages(Plugin):
 
     @Plugin.listener()
     async def on_raw_bulk_message_delete(self, payload):
-        messages = []
         now = discord.utils.utcnow()
+        messages = await self._get_messages(sorted(payload.message_ids))
 
-        for message_id in sorted(payload.message_ids):
-            message = await self._get_message(message_id)
-
-            if message is None:
-                continue
-
-            message = await self._update_message(message, deleted_at=now)
-            messages.append(await self._create_message(message))
+        messages = [await self._update_message(x, deleted_at=now) for x in messages]
+        messages = await self._create_messages(messages)
 
         if not messages:
             return
@@ -231,16 +488,31 @@ class Messages(Plugin):
         archive_url = await self.create_archive(messages)
         self.mousey.dispatch('mouse_bulk_message_delete', BulkMessageDeleteEvent(messages, archive_url))
 
+    def _get_cached_message(self, message_id):
+        message = self._messages.get(message_id) or self._updating.get(message_id) or self.cache.get(message_id)
+
+        if message is not None:
+            return message
+
+        # Messages replayed from the journal are only kept as encrypted rows until they are persisted
+        row = self._journaled.get(message_id) or self._persisting.get(message_id)
+
+        if row is not None:
+            message = decrypt_message(dict(zip(MESSAGE_COLUMNS, row)))
+            self.cache.put(message)
+
+            return message
+
     async def _get_message(self, message_id):
-        try:
-            return self._messages.get(message_id) or self._updating[message_id]
-        except KeyError:
-            pass
+        message = self._get_cached_message(message_id)
+
+        if message is not None:
+            return message
 
         async with self.mousey.db.acquire() as conn:
             record = await conn.fetchrow(
-                """
-                SELECT id, author_id, channel_id, content, embeds, attachments, edited_at, deleted_at
+                f"""
+                SELECT {SELECT_COLUMNS}
                 FROM messages
                 WHERE id = $1
                 """,
@@ -248,28 +520,153 @@ class Messages(Plugin):
             )
 
         if record is not None:
-            return decrypt_message(record)
+            message = decrypt_message(record)
+            self.cache.put(message)
+
+            return message
+
+    async def _get_messages(self, message_ids):
+        found = {}
+        missing = []
+
+        for message_id in message_ids:
+            message = self._get_cached_message(message_id)
+
+            if message is None:
+                missing.append(message_id)
+            else:
+                found[message_id] = message
+
+        if missing:
+            async with self.mousey.db.acquire() as conn:
+                records = await conn.fetch(
+                    f"""
+                    SELECT {SELECT_COLUMNS}
+                    FROM messages
+                    WHERE id = ANY($1)
+                    """,
+                    missing,
+                )
+
+            for message in await decrypt_messages(records):
+                self.cache.put(message)
+                found[message['id']] = message
+
+        return [found[x] for x in message_ids if x in found]
 
     async def _update_message(self, message, **fields):
         # Don't update the original reference
         message = {**message, **fields}
 
         message_id = message['id']
+
         self._messages[message_id] = message
+        self._unjournaled[message_id] = message
 
+        self._journal_scheduler.add()
+        self.scheduler.add(size=estimate_size(message))
+
+        self.cache.put(message)
         return message
 
-    async def _create_message(self, message):
+    async def _create_message(self, message, author=None):
         channel_id = message['channel_id']
         channel = self.mousey.get_channel(channel_id)
 
         if channel is None:
             raise InvalidMessage
 
-        author = await self._get_author(message, channel.guild)
+        if author is None:
+            author = await self._get_author(message, channel.guild)
+
         return Message(**message, author=author, channel=channel)
 
-    async def _set_author(self, message_id, author):
+    async def _create_messages(self, messages):
+        created = []
+        authors = await self._fetch_authors(messages)
+
+        for message in messages:
+            author = authors.get(message['id'])
+
+            # Authors which could not be fetched, eg. deleted accounts
+            if author is None and message['id'] in authors:
+                continue
+
+            try:
+                created.append(await self._create_message(message, author))
+            except InvalidMessage:
+                continue
+
+        return created
+
+    async def _fetch_authors(self, messages):
+        """Look up uncached authors of many messages at once, authors which could not be fetched are None."""
+
+        authors = {}
+
+        legacy_ids = []
+        webhook_authors = {}
+
+        for message in messages:
+            if message['author_id'] is not None:
+                continue
+
+            webhook_author_id = message['webhook_author_id']
+
+            if webhook_author_id is None:
+                legacy_ids.append(message['id'])
+                continue
+
+            author = self._authors.get(webhook_author_id)
+
+            if author is not None:
+                authors[message['id']] = author
+            else:
+                webhook_authors.setdefault(webhook_author_id, []).append(message['id'])
+
+        if legacy_ids:
+            values = await self.mousey.redis.mget([f'mousey:message-author:{x}' for x in legacy_ids])
+
+            for message_id, data in zip(legacy_ids, values):
+                if data is not None:
+                    authors[message_id] = self._create_author(data)
+
+        if webhook_authors:
+            async with self.mousey.db.acquire() as conn:
+                records = await conn.fetch(
+                    'SELECT id, data FROM message_authors WHERE id = ANY($1)', list(webhook_authors)
+                )
+
+            for record in records:
+                author = self._create_author(record['data'])
+                self._authors.put(record['id'], author)
+
+                for message_id in webhook_authors[record['id']]:
+                    authors[message_id] = author
+
+        # Every user is only fetched once, no matter how many of the messages they sent
+        user_ids = set(x['author_id'] for x in messages if x['author_id'] is not None)
+        missing = [x for x in user_ids if self.mousey.get_user(x) is None]
+
+        users = await asyncio.gather(*map(self.mousey.fetch_user, missing), return_exceptions=True)
+
+        for result in users:
+            if isinstance(result, Exception) and not isinstance(result, discord.HTTPException):
+                raise result
+
+        users = dict(zip(missing, users))
+
+        for message in messages:
+            user = users.get(message['author_id'])
+
+            if isinstance(user, discord.HTTPException):
+                authors[message['id']] = None
+            elif user is not None:
+                authors[message['id']] = user
+
+        return authors
+
+    def _intern_author(self, author):
         data = {
             'id': author.id,
             'bot': author.bot,
@@ -278,60 +675,322 @@ class Messages(Plugin):
             'avatar': author.avatar and author.avatar.key,
         }
 
-        data = encrypt_json(data)
-        await self.mousey.redis.set(f'mousey:message-author:{message_id}', data, ex=86400 * 30)
+        # Identical webhook authors share one ID
+        webhook_author_id = hash_json(data)
+        self._authors.put(webhook_author_id, author)
+
+        return webhook_author_id, data
+
+    async def _store_author(self, webhook_author_id, data):
+        now = time.monotonic()
+        stored_at = self._stored_authors.get(webhook_author_id)
+
+        if stored_at is not None and now - stored_at < AUTHOR_REFRESH_INTERVAL:
+            return
+
+        async with self.mousey.db.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO message_authors (id, data)
+                VALUES ($1, $2)
+                ON CONFLICT (id) DO UPDATE
+                SET updated_at = NOW()
+                """,
+                webhook_author_id,
+                encrypt_json(data),
+            )
+
+        self._stored_authors.put(webhook_author_id, now)
 
     async def _get_author(self, message, guild):
         message_id = message['id']
         author_id = message['author_id']
 
-        if author_id is None:  # Webhook user
+        if author_id is not None:
+            return (
+                guild.get_member(author_id)
+                or self.mousey.get_user(author_id)
+                or await self.mousey.fetch_user(author_id)
+            )
+
+        webhook_author_id = message['webhook_author_id']
+
+        if webhook_author_id is None:  # Stored before webhook authors were deduplicated
             data = await self.mousey.redis.get(f'mousey:message-author:{message_id}')
+        else:
+            author = self._authors.get(webhook_author_id)
+
+            if author is not None:
+                return author
+
+            async with self.mousey.db.acquire() as conn:
+                data = await conn.fetchval('SELECT data FROM message_authors WHERE id = $1', webhook_author_id)
+
+        if data is None:
+            raise InvalidMessage
+
+        author = self._create_author(data)
 
-            if data is None:
-                raise InvalidMessage
+        if webhook_author_id is not None:
+            self._authors.put(webhook_author_id, author)
 
-            # noinspection PyProtectedMember
-            return discord.User(data=decrypt_json(data), state=self.mousey._connection)
+        return author
 
-        return guild.get_member(author_id) or self.mousey.get_user(author_id) or await self.mousey.fetch_user(author_id)
+    def _create_author(self, data):
+        # noinspection PyProtectedMember
+        return discord.User(data=decrypt_json(data), state=self.mousey._connection)
 
     # Background tasks
 
-    @tasks.loop(seconds=1)
+    @tasks.loop(seconds=0)
+    async def journal_messages(self):
+        await self._journal_scheduler.wait()
+
+        async with self._journal_lock:
+            await self._journal_messages()
+
+    @journal_messages.before_loop
+    async def _open_journal(self):
+        await self.mousey.wait_until_ready()
+
+        path = pathlib.Path(JOURNAL_PATH, str(self.mousey.shard_id), 'messages')
+        self._journal = Journal(path)
+
+        # Messages which were not persisted before the last shutdown
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, self._journal.replay)
+
+        if rows:
+            self.scheduler.add(len(rows))
+            self._journaled.update((x[0], x) for x in rows)
+
+        self.persist_messages.start()
+
+    @tasks.loop(seconds=0)
     async def persist_messages(self):
+        await self.scheduler.wait()
         await self._persist_messages()
 
     @persist_messages.after_loop
+    async def _close_journal(self):
+        await self._persist_messages()
+        self._journal.close()
+
+    async def _journal_messages(self):
+        self._journal_scheduler.start()
+
+        messages = list(self._unjournaled.values())
+        self._unjournaled = {}
+
+        if not messages:
+            return
+
+        # Fernet releases the GIL during crypto operations,
+        # Which prevents large batches from blocking the event loop
+        rows = await encrypt_messages(messages)
+        self._journaled.update((x[0], x) for x in rows)
+
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._journal.write, rows)
+        except OSError:
+            log.exception(f'Failed to journal {len(rows)} messages.')
+
+        self._journal_scheduler.finish()
+
     async def _persist_messages(self):
-        self._updating = self._messages
-        self._messages = {}
+        # Everything pending needs to be journaled before rotating,
+        # Segments can only be removed once everything written to them is persisted
+        async with self._journal_lock:
+            await self._journal_messages()
+
+            self.scheduler.start()
+            self._segments.extend(self._journal.rotate())
+
+            self._updating = self._messages
+            self._messages = {}
+
+            updates = self._journaled
+            self._journaled = {}
+
+        # Partitions of expired messages may already be dropped, eg. when editing a cached message
+        expired = discord.utils.time_snowflake(discord.utils.utcnow() - RETENTION)
+        updates = {k: v for k, v in updates.items() if k >= expired}
+
+        if not updates:
+            self._finish_persist()
+            return
+
+        self._persisting = updates
+
+        try:
+            async with self.mousey.db.acquire() as conn:
+                ranges = await get_partition_ranges(conn)
+
+                # Writing messages without a partition fails the whole batch, retrying them would fail forever
+                unpartitioned = [x for x in updates if not is_partitioned(ranges, x)]
+
+                if unpartitioned:
+                    log.warning(f'Dropping {len(unpartitioned)} messages without a partition.')
+
+                    for message_id in unpartitioned:
+                        del updates[message_id]
+
+                if len(updates) >= COPY_THRESHOLD:
+                    await self._copy_messages(conn, list(updates.values()))
+                elif updates:
+                    await self._insert_messages(conn, list(updates.values()))
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            log.exception(f'Failed to persist {len(updates)} messages.')
+
+            # Keep newer updates which happened while flushing
+            self._journaled = {**updates, **self._journaled}
+            self._messages = {**self._updating, **self._messages}
+
+            self._persisting = {}
+
+            self.scheduler.finish(success=False)
+            return
+
+        self._finish_persist()
+
+    def _finish_persist(self):
+        self._persisting = {}
+        self.scheduler.finish()
+
+        segments = self._segments
+        self._segments = []
+
+        self._journal.remove(segments)
+
+    async def _insert_messages(self, conn, updates):
+        max_size = int(PGSQL_ARG_LIMIT / 7)
+
+        for chunk in more_itertools.chunked(updates, max_size):
+            await conn.execute(
+                f"""
+                INSERT INTO messages (id, author_id, channel_id, data, edited_at, deleted_at, webhook_author_id)
+                VALUES {multirow_insert(chunk)}
+                ON CONFLICT (id) DO UPDATE
+                SET data = EXCLUDED.data, content = NULL, embeds = NULL, attachments = NULL,
+                    edited_at = EXCLUDED.edited_at, deleted_at = EXCLUDED.deleted_at
+                """,
+                *itertools.chain.from_iterable(chunk),
+            )
+
+    async def _copy_messages(self, conn, updates):
+        async with conn.transaction():
+            # Temporary tables live as long as the pooled connection, rows are removed on commit
+            await conn.execute(
+                """
+                CREATE TEMPORARY TABLE IF NOT EXISTS message_updates (LIKE messages INCLUDING DEFAULTS)
+                ON COMMIT DELETE ROWS
+                """
+            )
+
+            await conn.copy_records_to_table('message_updates', records=updates, columns=MESSAGE_COLUMNS)
+
+            await conn.execute(
+                """
+                INSERT INTO messages (id, author_id, channel_id, data, edited_at, deleted_at, webhook_author_id)
+                SELECT id, author_id, channel_id, data, edited_at, deleted_at, webhook_author_id
+                FROM message_updates
+                ON CONFLICT (id) DO UPDATE
+                SET data = EXCLUDED.data, content = NULL, embeds = NULL, attachments = NULL,
+                    edited_at = EXCLUDED.edited_at, deleted_at = EXCLUDED.deleted_at
+                """
+            )
 
-        max_size = int(PGSQL_ARG_LIMIT / 8)
-        updates = map(encrypt_message, self._updating.values())
+    @tasks.loop(seconds=1)
+    async def migrate_messages(self):
+        if self._migrated:
+            self.migrate_messages.stop()
+            return
 
         async with self.mousey.db.acquire() as conn:
-            for chunk in more_itertools.chunked(updates, max_size):
-                await conn.execute(
+            async with conn.transaction():
+                # Other shards skip rows locked here and migrate the next batch instead
+                records = await conn.fetch(
                     f"""
-                    INSERT INTO messages (
-                      id, author_id, channel_id, content, embeds, attachments, edited_at, deleted_at
-                    )
-                    VALUES {multirow_insert(chunk)}
-                    ON CONFLICT (id) DO UPDATE
-                    SET content = EXCLUDED.content,
-                        embeds = EXCLUDED.embeds, attachments = EXCLUDED.attachments,
-                        edited_at = EXCLUDED.edited_at, deleted_at = EXCLUDED.deleted_at
+                    SELECT {SELECT_COLUMNS}
+                    FROM messages
+                    WHERE id > $1 AND data IS NULL
+                    ORDER BY id ASC
+                    LIMIT $2
+                    FOR UPDATE SKIP LOCKED
                     """,
-                    *itertools.chain.from_iterable(chunk),
+                    self._migrated_id,
+                    MIGRATION_BATCH_SIZE,
                 )
 
+                if not records:
+                    # Rows locked by other shards are skipped, these are retried in case migrating them fails
+                    if await conn.fetchval('SELECT EXISTS(SELECT 1 FROM messages WHERE data IS NULL)'):
+                        self._migrated_id = 0
+                        return
+
+                    await self.mousey.redis.set(MIGRATED_KEY, 1)
+
+                    self._migrated = True
+                    self.migrate_messages.stop()
+                    return
+
+                messages = await decrypt_messages(records)
+                updates = await encrypt_messages(messages)
+
+                await conn.execute(
+                    """
+                    UPDATE messages
+                    SET data = updates.data, content = NULL, embeds = NULL, attachments = NULL
+                    FROM unnest($1::BIGINT[], $2::BYTEA[]) AS updates (id, data)
+                    WHERE messages.id = updates.id
+                    """,
+                    # Rows are ordered as in MESSAGE_COLUMNS
+                    [x[0] for x in updates],
+                    [x[3] for x in updates],
+                )
+
+        self._migrated_id = records[-1]['id']
+
+    @migrate_messages.before_loop
+    async def _before_migrate_messages(self):
+        self._migrated = bool(await self.mousey.redis.exists(MIGRATED_KEY))
+
     @tasks.loop(hours=1)
     async def delete_old_messages(self):
         now = discord.utils.utcnow()
 
-        month_ago = now - datetime.timedelta(days=30)
-        snowflake = discord.utils.time_snowflake(month_ago)
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        expired = discord.utils.time_snowflake(now - RETENTION)
 
         async with self.mousey.db.acquire() as conn:
-            await conn.execute('DELETE FROM messages WHERE id < $1', snowflake)
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', PARTITION_LOCK_ID)
+
+                partitions = await get_partitions(conn)
+                created_until = max(partitions.values(), default=0)
+
+                for offset in range(PARTITIONS_AHEAD + 1):
+                    day = today + datetime.timedelta(days=offset)
+                    lower, upper = partition_range(day)
+
+                    # Partitions may not overlap, eg. with a migrated legacy table
+                    if lower < created_until:
+                        continue
+
+                    await conn.execute(
+                        f'CREATE TABLE {partition_name(day)} PARTITION OF messages FOR VALUES FROM ({lower}) TO ({upper})'
+                    )
+
+                for name, upper in partitions.items():
+                    if upper <= expired:
+                        await conn.execute(f'DROP TABLE {name}')
+
+            # Authors are marked as used while they send messages, so these can no longer be referenced
+            await conn.execute(
+                'DELETE FROM message_authors WHERE updated_at < $1',
+                now - RETENTION - datetime.timedelta(seconds=AUTHOR_REFRESH_INTERVAL),
+            )
+
+        # Edits of cached messages would otherwise be written to dropped partitions
+        self.cache.remove_before(expired)
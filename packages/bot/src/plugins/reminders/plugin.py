@@ -20,7 +20,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
 import datetime
+import heapq
+import logging
 import re
+import time
 import typing
 
 import discord
@@ -39,6 +42,18 @@ from ...utils import (
 from .converter import reminder_content, reminder_id
 
 
+log = logging.getLogger(__name__)
+
+# Reminders expiring within this many seconds are kept in memory, up to a maximum amount
+REMINDER_WINDOW = 3600
+REMINDER_WINDOW_SIZE = 1_000
+# Reminders are reloaded regularly in case they were changed elsewhere
+REMINDER_REFRESH_INTERVAL = 600
+
+# Amount of due reminders delivered at once
+DELIVERY_CONCURRENCY = 10
+
+
 def is_mentionable(role):
     return role.mentionable
 
@@ -47,7 +62,17 @@ class Reminders(Plugin):
     def __init__(self, mousey):
         super().__init__(mousey)
 
-        self._next = None
+        # Reminder ID -> reminder, for upcoming reminders of this shard
+        self._reminders = {}
+        # Heap of expires at, reminder ID, entries are skipped once outdated
+        self._queue = []
+
+        # Reminders expiring after this are loaded with the next window
+        self._loaded_until = None
+        # Reminder ID -> reminder or None, for changes made while loading
+        self._changes = None
+
+        self._wake = asyncio.Event()
         self._task = create_task(self._fulfill_reminders())
 
     def cog_unload(self):
@@ -97,9 +122,16 @@ class Reminders(Plugin):
         resp = await self.mousey.api.create_reminder(data)
         idx = resp['id']
 
-        if self._next is None or self._next > expires:
-            self._task.cancel()
-            self._task = create_task(self._fulfill_reminders())
+        reminder = {
+            'id': idx,
+            'user_id': ctx.author.id,
+            'thread_id': None,
+            'referenced_message_id': None,
+            **data,
+        }
+
+        del reminder['user']
+        self._schedule_reminder(reminder)
 
         about = f'about {message} ' if message else ''
         await ctx.send(f'I will remind you {about}{response}. #{idx}')
@@ -156,9 +188,7 @@ class Reminders(Plugin):
         now = datetime.datetime.utcnow()
         expires_at = datetime.datetime.fromisoformat(resp['expires_at'])
 
-        if self._next is not None:
-            self._task.cancel()
-            self._task = create_task(self._fulfill_reminders())
+        self._schedule_reminder(resp)
 
         await ctx.send(
             f'Successfully updated reminder #{reminder}, I will remind you in {human_delta(expires_at - now)}.'
@@ -234,6 +264,8 @@ class Reminders(Plugin):
             if resp['user_id'] != ctx.author.id:
                 continue
 
+            self._unschedule_reminder(idx)
+
             try:
                 await self.mousey.api.delete_reminder(idx)
             except NotFound:
@@ -242,106 +274,203 @@ class Reminders(Plugin):
                 deleted += 1
 
         if deleted:
-            if self._next is not None:
-                self._task.cancel()
-                self._task = create_task(self._fulfill_reminders())
-
             msg = f'Successfully deleted {Plural(deleted):reminder}.'
         else:
             msg = 'Unable to delete reminder, it may already be deleted or not belong to you.'
 
         await ctx.send(msg)
 
+    def _schedule_reminder(self, reminder):
+        if self._changes is not None:
+            self._changes[reminder['id']] = reminder
+
+        expires_at = datetime.datetime.fromisoformat(reminder['expires_at'])
+
+        # Loaded with the next window instead
+        if self._loaded_until is not None and expires_at > self._loaded_until:
+            self._reminders.pop(reminder['id'], None)
+            return
+
+        self._reminders[reminder['id']] = reminder
+        heapq.heappush(self._queue, (expires_at, reminder['id']))
+
+        self._wake.set()
+
+    def _unschedule_reminder(self, idx):
+        if self._changes is not None:
+            self._changes[idx] = None
+
+        self._reminders.pop(idx, None)
+
+    async def _load_reminders(self):
+        self._changes = {}
+        loaded_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=REMINDER_WINDOW)
+
+        try:
+            resp = await self.mousey.api.get_reminders(
+                self.mousey.shard_id, limit=REMINDER_WINDOW_SIZE, horizon=REMINDER_WINDOW
+            )
+        except NotFound:
+            resp = []
+        finally:
+            changes = self._changes
+            self._changes = None
+
+        if len(resp) < REMINDER_WINDOW_SIZE:
+            self._loaded_until = loaded_until
+        else:
+            self._loaded_until = datetime.datetime.fromisoformat(resp[-1]['expires_at'])
+
+        reminders = {x['id']: x for x in resp}
+
+        # Changes made while loading may not be included in the response
+        for idx, reminder in changes.items():
+            if reminder is None:
+                reminders.pop(idx, None)
+            else:
+                reminders[idx] = reminder
+
+        self._reminders = {}
+        self._queue = []
+
+        for reminder in reminders.values():
+            self._schedule_reminder(reminder)
+
+    def _pop_due_reminders(self):
+        now = datetime.datetime.utcnow()
+        due = []
+
+        while self._queue and self._queue[0][0] <= now:
+            expires_at, idx = heapq.heappop(self._queue)
+            reminder = self._reminders.get(idx)
+
+            # Entries of cancelled or edited reminders are outdated
+            if reminder is None or datetime.datetime.fromisoformat(reminder['expires_at']) != expires_at:
+                continue
+
+            del self._reminders[idx]
+            due.append(reminder)
+
+        return due
+
     async def _fulfill_reminders(self):
         await self.mousey.wait_until_ready()
 
+        refresh_at = 0
+
         while not self.mousey.is_closed():
+            # Load the next window once the current one has passed
+            if time.monotonic() >= refresh_at or datetime.datetime.utcnow() >= self._loaded_until:
+                await self._load_reminders()
+                refresh_at = time.monotonic() + REMINDER_REFRESH_INTERVAL
+
+            due = self._pop_due_reminders()
+
+            if due:
+                await asyncio.shield(self._deliver_reminders(due))
+                continue
+
+            now = datetime.datetime.utcnow()
+            timeout = min(refresh_at - time.monotonic(), (self._loaded_until - now).total_seconds())
+
+            if self._queue:
+                timeout = min(timeout, (self._queue[0][0] - now).total_seconds())
+
+            self._wake.clear()
+
             try:
-                resp = await self.mousey.api.get_reminders(self.mousey.shard_id)
-            except NotFound:
-                return
+                await asyncio.wait_for(self._wake.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
 
-            reminder = resp[0]
-            expires_at = datetime.datetime.fromisoformat(reminder['expires_at'])
+    async def _deliver_reminders(self, reminders):
+        semaphore = asyncio.Semaphore(DELIVERY_CONCURRENCY)
 
-            self._next = expires_at
-            await discord.utils.sleep_until(expires_at)
+        async def deliver(reminder):
+            async with semaphore:
+                return await self._deliver_reminder(reminder)
 
-            guild = self.mousey.get_guild(reminder['guild_id'])
+        results = await asyncio.gather(*map(deliver, reminders), return_exceptions=True)
 
-            if guild is None:
-                await asyncio.shield(self._delete_reminder(reminder['id']))
-                continue
+        # Failed reminders are not deleted, which retries them once they are loaded again
+        for reminder, result in zip(reminders, results):
+            if isinstance(result, Exception):
+                log.exception(f'Failed to deliver reminder {reminder["id"]}.', exc_info=result)
 
-            if guild.unavailable:
-                # Reschedule until the guild is hopefully available again
-                expires_at += datetime.timedelta(minutes=5)
-                await asyncio.shield(self._reschedule_reminder(reminder['id'], expires_at))
-                continue
+        await self._delete_reminders([x['id'] for x, done in zip(reminders, results) if done is True])
 
-            channel = guild.get_channel(reminder['channel_id'])
+    async def _deliver_reminder(self, reminder):
+        guild = self.mousey.get_guild(reminder['guild_id'])
 
-            if channel is None or not channel.permissions_for(channel.guild.me).send_messages:
-                await asyncio.shield(self._delete_reminder(reminder['id']))
-                continue
+        if guild is None:
+            return True
 
-            message_id = reminder['message_id']
+        if guild.unavailable:
+            # Reschedule until the guild is hopefully available again
+            expires_at = datetime.datetime.fromisoformat(reminder['expires_at'])
+            await self._reschedule_reminder(reminder['id'], expires_at + datetime.timedelta(minutes=5))
 
-            now = discord.utils.utcnow()
-            created_at = discord.utils.snowflake_time(message_id)
+            return False
 
-            user_id = reminder['user_id']
-            content = reminder['message']
-            created = human_delta(now - created_at)
+        channel = guild.get_channel(reminder['channel_id'])
 
-            content = f'Hey <@!{user_id}> {PURRL}! You asked to be reminded about {content} {created} ago.'
+        if channel is None or not channel.permissions_for(channel.guild.me).send_messages:
+            return True
 
-            member = guild.get_member(user_id)
+        message_id = reminder['message_id']
 
-            roles = re.findall(r'<@&?(\d{15,21})>', reminder['message'])
-            roles = filter(None, (guild.get_role(int(x)) for x in roles))
+        now = discord.utils.utcnow()
+        created_at = discord.utils.snowflake_time(message_id)
 
-            if member is None:
-                everyone = False
-                roles = list(filter(is_mentionable, roles))
-            else:
-                everyone = channel.permissions_for(member).mention_everyone
-                roles = [x for x in roles if everyone or is_mentionable(x)]
+        user_id = reminder['user_id']
+        content = reminder['message']
+        created = human_delta(now - created_at)
 
-            destination_id = reminder['thread_id'] or channel.id
+        content = f'Hey <@!{user_id}> {PURRL}! You asked to be reminded about {content} {created} ago.'
 
-            referenced_message_id = reminder['referenced_message_id'] or message_id
-            mentions = discord.AllowedMentions(everyone=everyone, roles=set(roles), users=True)
+        member = guild.get_member(user_id)
 
-            message_reference = {
-                'fail_if_not_exists': False,
-                'message_id': referenced_message_id,
-            }
+        roles = re.findall(r'<@&?(\d{15,21})>', reminder['message'])
+        roles = filter(None, (guild.get_role(int(x)) for x in roles))
 
-            try:
-                # Use http.send_message in case this reminder is for an archived or deleted thread
-                # If the thread is deleted we get a 404 error either way, so we can just not do the request
-                await self.mousey.http.send_message(
-                    destination_id, content, allowed_mentions=mentions.to_dict(), message_reference=message_reference
-                )
-            except discord.HTTPException as e:
-                pass
+        if member is None:
+            everyone = False
+            roles = list(filter(is_mentionable, roles))
+        else:
+            everyone = channel.permissions_for(member).mention_everyone
+            roles = [x for x in roles if everyone or is_mentionable(x)]
+
+        destination_id = reminder['thread_id'] or channel.id
 
-            await asyncio.shield(self._delete_reminder(reminder['id']))
+        referenced_message_id = reminder['referenced_message_id'] or message_id
+        mentions = discord.AllowedMentions(everyone=everyone, roles=set(roles), users=True)
 
-    async def _delete_reminder(self, idx):
-        self._next = None
+        message_reference = {
+            'fail_if_not_exists': False,
+            'message_id': referenced_message_id,
+        }
 
         try:
-            await self.mousey.api.delete_reminder(idx)
-        except NotFound:
+            # Use http.send_message in case this reminder is for an archived or deleted thread
+            # If the thread is deleted we get a 404 error either way, so we can just not do the request
+            await self.mousey.http.send_message(
+                destination_id, content, allowed_mentions=mentions.to_dict(), message_reference=message_reference
+            )
+        except discord.HTTPException:
             pass
 
+        return True
+
+    async def _delete_reminders(self, ids):
+        if ids:
+            await self.mousey.api.delete_reminders(ids)
+
     async def _reschedule_reminder(self, idx, expires_at):
-        self._next = None
-        expires_at = expires_at.isoformat()
+        data = {'expires_at': expires_at.isoformat()}
 
         try:
-            await self.mousey.api.update_reminder(idx, expires_at)
+            resp = await self.mousey.api.update_reminder(idx, data)
         except NotFound:
             pass
+        else:
+            self._schedule_reminder(resp)
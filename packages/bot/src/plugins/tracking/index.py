@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import array
+import bisect
+import datetime
+import itertools
+
+
+# Merging more new users than this rebuilds the index instead of inserting them one by one
+MERGE_INSERT_LIMIT = 64
+
+
+def to_timestamp(value):
+    if value is None:  # Missing timestamps are stored as zero
+        return 0.0
+
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def from_timestamp(value):
+    if value:
+        return datetime.datetime.utcfromtimestamp(value)
+
+
+class ActivityIndex:
+    """
+    Compact mapping of user IDs to one or more activity timestamps.
+
+    User IDs are kept sorted in an array with one parallel array of timestamps per column,
+    timestamps are seconds since the epoch and zero if no activity has been recorded.
+
+    Parameters
+    ----------
+    columns: int
+        The amount of timestamps stored per user.
+    """
+
+    def __init__(self, columns):
+        self.user_ids = array.array('Q')
+        self.columns = [array.array('d') for _ in range(columns)]
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return self._find(user_id) is not None
+
+    def get(self, user_id):
+        index = self._find(user_id)
+
+        if index is None:
+            return tuple(0.0 for _ in self.columns)
+
+        return tuple(x[index] for x in self.columns)
+
+    def update(self, user_id, column, timestamp):
+        """Record activity for a user, older timestamps and users which are not indexed yet are ignored."""
+
+        index = self._find(user_id)
+
+        if index is None:
+            return
+
+        values = self.columns[column]
+
+        if values[index] < timestamp:
+            values[index] = timestamp
+
+    def merge(self, rows):
+        """Add many users at once, given a mapping of user ID to a timestamp per column."""
+
+        added = []
+
+        for user_id, timestamps in rows.items():
+            index = self._find(user_id)
+
+            if index is None:
+                added.append(user_id)
+                continue
+
+            for values, timestamp in zip(self.columns, timestamps):
+                if values[index] < timestamp:
+                    values[index] = timestamp
+
+        added.sort()
+
+        # Inserting moves all following entries, which is only cheaper than rebuilding for few users
+        if len(added) <= MERGE_INSERT_LIMIT:
+            for user_id in added:
+                index = bisect.bisect_left(self.user_ids, user_id)
+                self.user_ids.insert(index, user_id)
+
+                for values, timestamp in zip(self.columns, rows[user_id]):
+                    values.insert(index, timestamp)
+
+            return
+
+        entries = sorted(itertools.chain(zip(self.user_ids, *self.columns), ((x, *rows[x]) for x in added)))
+
+        self.user_ids = array.array('Q', (x[0] for x in entries))
+        self.columns = [array.array('d', (x[column] for x in entries)) for column in range(1, len(self.columns) + 1)]
+
+    def remove(self, user_id):
+        index = self._find(user_id)
+
+        if index is None:
+            return
+
+        del self.user_ids[index]
+
+        for values in self.columns:
+            del values[index]
+
+    def _find(self, user_id):
+        index = bisect.bisect_left(self.user_ids, user_id)
+
+        if index != len(self.user_ids) and self.user_ids[index] == user_id:
+            return index
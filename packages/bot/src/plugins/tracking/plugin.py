@@ -19,17 +19,53 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import asyncio
+import collections
 import datetime
 import itertools
+import logging
+import pathlib
 import time
 import typing
 
+import aredis
+import asyncpg
 import discord
 import more_itertools
 from discord.ext import tasks
 
-from ... import Plugin
-from ...utils import PGSQL_ARG_LIMIT, multirow_insert
+from ... import JOURNAL_PATH, Plugin
+from ...utils import PGSQL_ARG_LIMIT, FlushScheduler, Journal, multirow_insert
+from .index import ActivityIndex, from_timestamp, to_timestamp
+
+
+log = logging.getLogger(__name__)
+
+# Pending updates are written to a local journal frequently,
+# Which allows writing them to the database less often
+JOURNAL_INTERVAL = 0.25
+
+# Pending updates are persisted once any of these limits is reached
+FLUSH_INTERVAL = 5
+FLUSH_MAX_ITEMS = 50_000
+
+# Flushes taking longer than this make the limits above grow temporarily
+SLOW_FLUSH_DURATION = 1
+
+# Presence updates are received once for every guild shared with a user,
+# Only the first update per user within this many seconds is processed
+PRESENCE_WINDOW = 5
+
+# Removed-at timestamps are kept in a sorted set per guild, trimmed to this many seconds
+REMOVED_AT_RETENTION = 86400 * 180
+# Amount of legacy removed-at keys scanned per migration step
+REMOVED_AT_MIGRATION_BATCH_SIZE = 1_000
+# Seconds to wait between migration steps, to not block Redis for other clients
+REMOVED_AT_MIGRATION_INTERVAL = 0.5
+
+# Amount of members whose activity is looked up per query
+LOOKUP_CHUNK_SIZE = 10_000
+# Activity of looked up members is kept for this many guilds which were looked up most recently
+GUILD_INDEX_LIMIT = 100
 
 
 def not_bot(func):
@@ -58,6 +94,8 @@ class Tracking(Plugin):
     def __init__(self, mousey):
         super().__init__(mousey)
 
+        # Pending updates store timestamps as seconds since the epoch
+
         # Discord status updates
         self._status_updates = {}
 
@@ -66,10 +104,52 @@ class Tracking(Plugin):
         # Sent message in guild
         self._spoke_updates = {}
 
-        self.persist_updates.start()
+        # Left guild, activity is deleted
+        self._removed_members = {}
+
+        self._journal = None
+        self._segments = []
+
+        # Updates not written to the journal yet
+        self._unjournaled = {}
+
+        self._journal_lock = asyncio.Lock()
+        self._journal_scheduler = FlushScheduler(JOURNAL_INTERVAL)
+
+        self.scheduler = FlushScheduler(
+            FLUSH_INTERVAL, name='tracking', max_items=FLUSH_MAX_ITEMS, slow_duration=SLOW_FLUSH_DURATION
+        )
+
+        # Users whose status was updated in the current presence window
+        self._presence_window = set()
+        self._presence_window_ends = 0
+
+        self.presence_received = 0
+        self.presence_coalesced = 0
+
+        # Updates currently being written to the database
+        self._persisting = {}
+
+        # Guild ID -> last status, last seen, last spoke of members which have been looked up,
+        # Kept current by update hooks
+        self._guild_indexes = collections.OrderedDict()
+
+        self._removed_at_cursor = 0
+        self._removed_at_migrated = False
+
+        self.journal_updates.start()
+        self.trim_removed_at.start()
+        self.migrate_removed_at.start()
 
     def cog_unload(self):
+        self.journal_updates.stop()
+        self._journal_scheduler.close()
+
         self.persist_updates.stop()
+        self.scheduler.close()
+
+        self.trim_removed_at.stop()
+        self.migrate_removed_at.cancel()
 
     async def get_last_status(self, member):
         statuses = await self.bulk_last_status(member)
@@ -79,31 +159,86 @@ class Tracking(Plugin):
         guild_id = members[0].guild.id
         user_ids = [x.id for x in members]
 
+        index = self._guild_indexes.get(guild_id)
+
+        if index is None:
+            index = self._guild_indexes[guild_id] = ActivityIndex(3)
+
+        self._guild_indexes.move_to_end(guild_id)
+
+        while len(self._guild_indexes) > GUILD_INDEX_LIMIT:
+            self._guild_indexes.popitem(last=False)
+
+        missing = [x for x in user_ids if x not in index]
+
+        if missing:
+            await self._load_activity(index, guild_id, missing)
+
+        statuses = []
+
+        for user_id in user_ids:
+            status, seen, spoke = index.get(user_id)
+            statuses.append(LastMemberStatus(from_timestamp(status), from_timestamp(seen), from_timestamp(spoke)))
+
+        return statuses
+
+    async def _load_activity(self, index, guild_id, user_ids):
+        # Users without any activity are indexed as well, to not look them up again
+        activity = {}
+
         async with self.mousey.db.acquire() as conn:
-            status_records = await conn.fetch(
-                'SELECT user_id, updated_at FROM status_updates WHERE user_id = ANY($1)', user_ids
-            )
+            for chunk in more_itertools.chunked(user_ids, LOOKUP_CHUNK_SIZE):
+                records = await conn.fetch(
+                    """
+                    SELECT users.user_id, status_updates.updated_at AS status,
+                      seen_updates.updated_at AS seen, spoke_updates.updated_at AS spoke
+                    FROM unnest($2::BIGINT[]) AS users (user_id)
+                    LEFT JOIN status_updates ON status_updates.user_id = users.user_id
+                    LEFT JOIN seen_updates ON seen_updates.guild_id = $1 AND seen_updates.user_id = users.user_id
+                    LEFT JOIN spoke_updates ON spoke_updates.guild_id = $1 AND spoke_updates.user_id = users.user_id
+                    """,
+                    guild_id,
+                    chunk,
+                )
 
-            seen_records = await conn.fetch(
-                'SELECT user_id, updated_at FROM seen_updates WHERE guild_id = $1 AND user_id = ANY($2)',
-                guild_id,
-                user_ids,
-            )
+                for record in records:
+                    activity[record['user_id']] = [
+                        to_timestamp(record['status']),
+                        to_timestamp(record['seen']),
+                        to_timestamp(record['spoke']),
+                    ]
 
-            spoke_records = await conn.fetch(
-                'SELECT user_id, updated_at FROM spoke_updates WHERE guild_id = $1 AND user_id = ANY($2)',
-                guild_id,
-                user_ids,
-            )
+        # Updates made before or during the lookup may not have been persisted yet,
+        # Update hooks ignore users until they are merged into the index
+        # Pending spoke updates also count as being seen
+        columns = {'status_updates': (0,), 'seen_updates': (1,), 'spoke_updates': (1, 2)}
+
+        for table, indexes in columns.items():
+            for updates in self._unpersisted_updates(table):
+                for user_id, timestamps in activity.items():
+                    value = updates.get(user_id if table == 'status_updates' else (guild_id, user_id))
 
-        status_updates = {x['user_id']: x['updated_at'] for x in status_records}
-        seen_updates = {x['user_id']: x['updated_at'] for x in seen_records}
-        spoke_updates = {x['user_id']: x['updated_at'] for x in spoke_records}
+                    if value is not None:
+                        for column in indexes:
+                            timestamps[column] = max(timestamps[column], value)
 
-        return [LastMemberStatus(status_updates.get(x), seen_updates.get(x), spoke_updates.get(x)) for x in user_ids]
+        index.merge(activity)
+
+    def _unpersisted_updates(self, table):
+        return self._persisting.get(table, {}), self._pending_updates()[table]
 
     async def get_removed_at(self, member):
-        value = await self.mousey.redis.get(f'mousey:removed-at:{member.guild.id}-{member.id}')
+        value = None
+
+        for updates in self._unpersisted_updates('removed_members'):
+            value = updates.get((member.guild.id, member.id), value)
+
+        if value is None:
+            value = await self.mousey.redis.zscore(f'mousey:removed-at:{member.guild.id}', member.id)
+
+        # Keys from before removals were stored per guild
+        if value is None and not self._removed_at_migrated:
+            value = await self.mousey.redis.get(f'mousey:removed-at:{member.guild.id}-{member.id}')
 
         if value is not None:
             return datetime.datetime.utcfromtimestamp(int(value))
@@ -151,8 +286,7 @@ class Tracking(Plugin):
 
     @Plugin.listener()
     async def on_member_remove(self, member):
-        await self._set_removed_at(member)
-        await self._remove_member_data(member)
+        self._remove_member(member)
 
     @Plugin.listener()
     async def on_mouse_guild_remove(self, event):
@@ -160,93 +294,359 @@ class Tracking(Plugin):
 
     @not_bot
     def _update_last_status(self, member):
-        now = datetime.datetime.utcnow()
+        now = int(time.time())
+        self.presence_received += 1
+
+        if now >= self._presence_window_ends:
+            self._presence_window = set()
+            self._presence_window_ends = now + PRESENCE_WINDOW
+
+        if member.id in self._presence_window:
+            self.presence_coalesced += 1
+            return
+
+        self._presence_window.add(member.id)
         self._status_updates[member.id] = now
 
+        # Statuses are not per guild, the user may be indexed for any guild
+        for index in self._guild_indexes.values():
+            index.update(member.id, 0, now)
+
+        self._journal_update('status_updates', member.id, now)
+
     @not_bot
     def _update_last_seen(self, member):
-        now = datetime.datetime.utcnow()
+        now = int(time.time())
         self._seen_updates[member.guild.id, member.id] = now
 
+        index = self._guild_indexes.get(member.guild.id)
+
+        if index is not None:
+            index.update(member.id, 1, now)
+
+        self._journal_update('seen_updates', (member.guild.id, member.id), now)
+
     @not_bot
     def _update_last_spoke(self, member):
-        now = datetime.datetime.utcnow()
+        now = int(time.time())
 
-        self._seen_updates[member.guild.id, member.id] = now
+        # Speaking counts as being seen, which is applied when persisting
         self._spoke_updates[member.guild.id, member.id] = now
 
+        index = self._guild_indexes.get(member.guild.id)
+
+        if index is not None:
+            index.update(member.id, 1, now)
+            index.update(member.id, 2, now)
+
+        self._journal_update('spoke_updates', (member.guild.id, member.id), now)
+
+    def _journal_update(self, table, key, value):
+        # Entries are replayed in the order they were added, a newer update needs to come after a removal
+        self._unjournaled.pop((table, key), None)
+        self._unjournaled[table, key] = value
+
+        self._schedule_updates(1)
+
+    def _schedule_updates(self, count):
+        self._journal_scheduler.add(count)
+        self.scheduler.add(count)
+
     @not_bot
-    async def _set_removed_at(self, member):
+    def _remove_member(self, member):
         now = int(time.time())
-        await self.mousey.redis.set(f'mousey:removed-at:{member.guild.id}-{member.id}', now, ex=86400 * 180)
+        key = member.guild.id, member.id
 
-    @not_bot
-    async def _remove_member_data(self, member):
-        async with self.mousey.db.acquire() as conn:
-            await conn.execute(
-                'DELETE FROM seen_updates WHERE guild_id = $1 AND user_id = $2', member.guild.id, member.id
-            )
+        # Removals are persisted before other updates,
+        # Activity from before leaving must not be written after it
+        self._seen_updates.pop(key, None)
+        self._spoke_updates.pop(key, None)
 
-            await conn.execute(
-                'DELETE FROM spoke_updates WHERE guild_id = $1 AND user_id = $2', member.guild.id, member.id
-            )
+        index = self._guild_indexes.get(member.guild.id)
+
+        if index is not None:
+            index.remove(member.id)
+
+        self._removed_members[key] = now
+
+        self._journal_update('removed_members', key, now)
 
     async def _remove_guild_member_data(self, guild):
+        self._guild_indexes.pop(guild.id, None)
+
         async with self.mousey.db.acquire() as conn:
             await conn.execute('DELETE FROM seen_updates WHERE guild_id = $1', guild.id)
             await conn.execute('DELETE FROM spoke_updates WHERE guild_id = $1', guild.id)
 
-    @tasks.loop(seconds=1)
+    @tasks.loop(seconds=0)
+    async def journal_updates(self):
+        await self._journal_scheduler.wait()
+
+        async with self._journal_lock:
+            await self._journal_updates()
+
+    @journal_updates.before_loop
+    async def _open_journal(self):
+        await self.mousey.wait_until_ready()
+
+        path = pathlib.Path(JOURNAL_PATH, str(self.mousey.shard_id), 'tracking')
+        self._journal = Journal(path)
+
+        # Updates which were not persisted before the last shutdown
+        loop = asyncio.get_running_loop()
+        entries = await loop.run_in_executor(None, self._journal.replay)
+
+        pending = self._pending_updates()
+
+        for table, key, value in entries:
+            updates = pending[table]
+
+            if table == 'removed_members':  # Entries are replayed in the order they were written
+                pending['seen_updates'].pop(key, None)
+                pending['spoke_updates'].pop(key, None)
+
+            if key not in updates or updates[key] < value:
+                updates[key] = value
+
+        if entries:
+            self.scheduler.add(len(entries))
+
+        self.persist_updates.start()
+
+    @tasks.loop(seconds=0)
     async def persist_updates(self):
+        await self.scheduler.wait()
         await self._persist_updates()
 
     @persist_updates.after_loop
+    async def _close_journal(self):
+        await self._persist_updates()
+        self._journal.close()
+
+    def _pending_updates(self):
+        return {
+            'status_updates': self._status_updates,
+            'seen_updates': self._seen_updates,
+            'spoke_updates': self._spoke_updates,
+            'removed_members': self._removed_members,
+        }
+
+    async def _journal_updates(self):
+        self._journal_scheduler.start()
+
+        if not self._unjournaled:
+            return
+
+        entries = [(*key, value) for key, value in self._unjournaled.items()]
+        self._unjournaled = {}
+
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._journal.write, entries)
+        except OSError:
+            log.exception(f'Failed to journal {len(entries)} tracking updates.')
+
+        self._journal_scheduler.finish()
+
     async def _persist_updates(self):
-        await self._persist_status_updates()
+        # Everything pending needs to be journaled before rotating,
+        # Segments can only be removed once everything written to them is persisted
+        async with self._journal_lock:
+            await self._journal_updates()
 
-        updates, self._seen_updates = self._seen_updates, {}
-        await self._persist_guild_updates('seen_updates', updates)
+            self.scheduler.start()
+            self._segments.extend(self._journal.rotate())
 
-        updates, self._spoke_updates = self._spoke_updates, {}
-        await self._persist_guild_updates('spoke_updates', updates)
+            pending = self._pending_updates()
 
-    async def _persist_status_updates(self):
-        updates, self._status_updates = self._status_updates, {}
+            self._status_updates = {}
+            self._seen_updates = {}
+            self._spoke_updates = {}
+            self._removed_members = {}
 
-        if not updates:
+        if not any(pending.values()):
             return
 
-        max_size = int(PGSQL_ARG_LIMIT / 2)
-        updates = sorted(updates.items())  # Sort prevents deadlock
+        self._persisting = pending
+
+        try:
+            await self._persist_removed_members(pending['removed_members'])
+            await self._persist_status_updates(pending['status_updates'])
+
+            await self._persist_guild_updates(pending['seen_updates'], pending['spoke_updates'])
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError, aredis.RedisError):
+            log.exception('Failed to persist tracking updates.')
+
+            # Members removed while flushing invalidate their earlier activity
+            for key in self._removed_members:
+                pending['seen_updates'].pop(key, None)
+                pending['spoke_updates'].pop(key, None)
+
+            # Keep newer updates which happened while flushing
+            self._status_updates = {**pending['status_updates'], **self._status_updates}
+            self._seen_updates = {**pending['seen_updates'], **self._seen_updates}
+            self._spoke_updates = {**pending['spoke_updates'], **self._spoke_updates}
+            self._removed_members = {**pending['removed_members'], **self._removed_members}
+
+            self._persisting = {}
+            self.scheduler.finish(success=False)
+            return
+
+        self._persisting = {}
+        self.scheduler.finish()
+
+        segments = self._segments
+        self._segments = []
+
+        self._journal.remove(segments)
+
+    async def _persist_removed_members(self, removed):
+        if not removed:
+            return
+
+        # Keys are tuples of guild id, user id, sort prevents deadlock
+        keys = sorted(removed)
+
+        guild_ids = [x[0] for x in keys]
+        user_ids = [x[1] for x in keys]
 
         async with self.mousey.db.acquire() as conn:
-            for chunk in more_itertools.chunked(updates, max_size):
+            for table in ('seen_updates', 'spoke_updates'):
                 await conn.execute(
                     f"""
-                    INSERT INTO status_updates (user_id, updated_at)
-                    VALUES {multirow_insert(chunk)}
-                    ON CONFLICT (user_id) DO UPDATE
-                    SET updated_at = EXCLUDED.updated_at
+                    DELETE FROM {table}
+                    WHERE (guild_id, user_id) IN (SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[]))
                     """,
-                    *itertools.chain.from_iterable(chunk),
+                    guild_ids,
+                    user_ids,
                 )
 
-    async def _persist_guild_updates(self, table, updates):
+        await self._set_removed_at(removed)
+
+    async def _set_removed_at(self, removed):
+        guilds = {}
+
+        for (guild_id, user_id), removed_at in removed.items():
+            guilds.setdefault(guild_id, []).extend((removed_at, user_id))
+
+        async with await self.mousey.redis.pipeline(transaction=False) as pipe:
+            for guild_id, values in guilds.items():
+                key = f'mousey:removed-at:{guild_id}'
+
+                await pipe.zadd(key, *values)
+                await pipe.expire(key, REMOVED_AT_RETENTION)
+
+            await pipe.execute()
+
+    async def _persist_status_updates(self, updates):
         if not updates:
             return
 
-        max_size = int(PGSQL_ARG_LIMIT / 3)
-        # guild_user_id is a tuple of guild id, user id
-        updates = [(*guild_user_id, seen) for guild_user_id, seen in updates.items()]
+        max_size = int(PGSQL_ARG_LIMIT / 2)
+        # Sort prevents deadlock
+        updates = sorted((user_id, from_timestamp(value)) for user_id, value in updates.items())
 
         async with self.mousey.db.acquire() as conn:
             for chunk in more_itertools.chunked(updates, max_size):
                 await conn.execute(
                     f"""
-                    INSERT INTO {table} (guild_id, user_id, updated_at)
+                    INSERT INTO status_updates (user_id, updated_at)
                     VALUES {multirow_insert(chunk)}
-                    ON CONFLICT (guild_id, user_id) DO UPDATE
+                    ON CONFLICT (user_id) DO UPDATE
                     SET updated_at = EXCLUDED.updated_at
                     """,
                     *itertools.chain.from_iterable(chunk),
                 )
+
+    async def _persist_guild_updates(self, seen_updates, spoke_updates):
+        # Keys are tuples of guild id, user id, sort prevents deadlock
+        keys = sorted(seen_updates.keys() | spoke_updates.keys())
+
+        if not keys:
+            return
+
+        seen = [from_timestamp(max(seen_updates.get(x, 0), spoke_updates.get(x, 0))) for x in keys]
+        spoke = [from_timestamp(spoke_updates.get(x)) for x in keys]
+
+        async with self.mousey.db.acquire() as conn:
+            await conn.execute(
+                """
+                WITH updates AS (
+                  SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TIMESTAMP[], $4::TIMESTAMP[])
+                    AS x (guild_id, user_id, seen_at, spoke_at)
+                ), seen AS (
+                  INSERT INTO seen_updates (guild_id, user_id, updated_at)
+                  SELECT guild_id, user_id, seen_at FROM updates
+                  ON CONFLICT (guild_id, user_id) DO UPDATE
+                  SET updated_at = GREATEST(seen_updates.updated_at, EXCLUDED.updated_at)
+                )
+                INSERT INTO spoke_updates (guild_id, user_id, updated_at)
+                SELECT guild_id, user_id, spoke_at FROM updates WHERE spoke_at IS NOT NULL
+                ON CONFLICT (guild_id, user_id) DO UPDATE
+                SET updated_at = GREATEST(spoke_updates.updated_at, EXCLUDED.updated_at)
+                """,
+                [x[0] for x in keys],
+                [x[1] for x in keys],
+                seen,
+                spoke,
+            )
+
+    @tasks.loop(hours=24)
+    async def trim_removed_at(self):
+        expired = int(time.time()) - REMOVED_AT_RETENTION
+
+        async with await self.mousey.redis.pipeline(transaction=False) as pipe:
+            for guild in self.mousey.guilds:
+                await pipe.zremrangebyscore(f'mousey:removed-at:{guild.id}', '-inf', expired)
+
+            await pipe.execute()
+
+    @trim_removed_at.before_loop
+    async def _before_trim_removed_at(self):
+        await self.mousey.wait_until_ready()
+
+    @tasks.loop(seconds=REMOVED_AT_MIGRATION_INTERVAL)
+    async def migrate_removed_at(self):
+        redis = self.mousey.redis
+
+        if self._removed_at_migrated:
+            self.migrate_removed_at.stop()
+            return
+
+        self._removed_at_cursor, keys = await redis.scan(
+            self._removed_at_cursor, match='mousey:removed-at:*-*', count=REMOVED_AT_MIGRATION_BATCH_SIZE
+        )
+
+        # Every shard scans all keys, but only migrates those of its own guilds
+        shard_keys = {}
+
+        for key in keys:
+            guild_id, user_id = map(int, key.decode().rpartition(':')[2].split('-'))
+
+            if (guild_id >> 22) % self.mousey.shard_count == self.mousey.shard_id:
+                shard_keys[guild_id, user_id] = key
+
+        if shard_keys:
+            values = await redis.mget(list(shard_keys.values()))
+            removed = {key: int(value) for key, value in zip(shard_keys, values) if value is not None}
+
+            if removed:
+                await self._set_removed_at(removed)
+
+            await redis.delete(*shard_keys.values())
+
+        if not self._removed_at_cursor:
+            await redis.set(self._removed_at_migrated_key(), 1)
+
+            self._removed_at_migrated = True
+            self.migrate_removed_at.stop()
+
+    @migrate_removed_at.before_loop
+    async def _before_migrate_removed_at(self):
+        await self.mousey.wait_until_ready()
+
+        self._removed_at_migrated = bool(await self.mousey.redis.exists(self._removed_at_migrated_key()))
+
+    def _removed_at_migrated_key(self):
+        # Guilds are assigned to other shards when the shard count changes, which need to be migrated again
+        return f'mousey:removed-at-migrated:{self.mousey.shard_id}-{self.mousey.shard_count}'
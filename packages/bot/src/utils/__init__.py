@@ -21,7 +21,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from .asyncio import create_task
 from .formatting import Plural, code_safe, describe, describe_user, user_name
 from .helpers import create_paste, has_membership_screening, populate_methods, serialize_user
+from .journal import Journal
 from .logging import setup_logging
 from .paginator import PaginatorInterface, close_interface_context
+from .scheduler import FlushScheduler
 from .sql import PGSQL_ARG_LIMIT, multirow_insert
 from .time import TimeConverter, human_delta
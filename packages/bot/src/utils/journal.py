@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import pathlib
+import pickle
+import struct
+import threading
+import zlib
+
+
+_HEADER = struct.Struct('<II')  # Entry size, checksum
+
+
+class Journal:
+    """
+    Append-only log of pending writes, allowing them to be recovered after a crash.
+
+    Entries are appended to the current segment file. Before flushing pending writes
+    the journal is rotated, rotated segments can be removed once the flush succeeded.
+
+    Methods do blocking IO and should be run in an executor when called frequently.
+
+    Parameters
+    ----------
+    path: Union[str, pathlib.Path]
+        The directory to store segment files in.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+
+        # Segments left over from a previous process are included in the next rotation
+        self._rotated = sorted(self.path.glob('*.log'))
+
+        self._index = max((int(x.stem) for x in self._rotated), default=0)
+        self._file = self._open_segment()
+
+    def replay(self):
+        """Returns all entries written to segments which have not been removed yet."""
+
+        entries = []
+
+        for segment in self._rotated:
+            entries.extend(_read_segment(segment))
+
+        return entries
+
+    def write(self, entries):
+        """Append entries to the current segment and make sure they are stored on disk."""
+
+        with self._lock:
+            for entry in entries:
+                data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+                self._file.write(_HEADER.pack(len(data), zlib.crc32(data)) + data)
+
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Start a new segment, returns all segments not written to anymore."""
+
+        with self._lock:
+            self._file.close()
+            self._rotated.append(pathlib.Path(self._file.name))
+
+            self._file = self._open_segment()
+            segments, self._rotated = self._rotated, []
+
+        return segments
+
+    def remove(self, segments):
+        for segment in segments:
+            segment.unlink(missing_ok=True)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _open_segment(self):
+        self._index += 1
+        return open(self.path / f'{self._index:020}.log', 'ab')
+
+
+def _read_segment(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    offset = 0
+
+    while offset + _HEADER.size <= len(data):
+        size, checksum = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+
+        entry = data[offset : offset + size]
+        offset += size
+
+        # The process may have stopped while writing the last entry
+        if len(entry) != size or zlib.crc32(entry) != checksum:
+            break
+
+        yield pickle.loads(entry)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mousey: Discord Moderation Bot
+Copyright (C) 2016 - 2021 Lilly Rose Berner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class FlushScheduler:
+    """
+    Decides when pending writes should be flushed.
+
+    A flush is due once the amount or approximate size of pending writes reaches a limit,
+    or when the oldest pending write has waited for max_delay seconds. Slow or failing flushes
+    multiply all limits by a backoff factor, which decays again once flushes are fast.
+
+    Parameters
+    ----------
+    max_delay: float
+        The amount of seconds the oldest pending write may wait.
+    name: Optional[str]
+        Used to log the result of every flush, flushes are not logged without a name.
+    max_items: Optional[int]
+        The amount of pending writes to flush at immediately.
+    max_bytes: Optional[int]
+        The approximate size of pending writes to flush at immediately.
+    slow_duration: Optional[float]
+        Flushes taking longer than this amount of seconds increase the backoff.
+    max_backoff: int
+        The maximum factor limits are multiplied with.
+    """
+
+    def __init__(self, max_delay, *, name=None, max_items=None, max_bytes=None, slow_duration=None, max_backoff=16):
+        self.name = name
+        self.max_delay = max_delay
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self.slow_duration = slow_duration
+        self.max_backoff = max_backoff
+
+        # Pending writes
+        self.items = 0
+        self.bytes = 0
+
+        self.backoff = 1
+
+        self.flushes = 0
+        self.failures = 0
+
+        self.last_duration = 0
+        self.average_duration = 0
+
+        self._batch = (0, 0)
+        self._started_at = None
+        self._pending_since = None
+
+        self._closed = False
+        self._event = asyncio.Event()
+
+    def __repr__(self):
+        return (
+            f'<FlushScheduler items={self.items} bytes={self.bytes} backoff={self.backoff} '
+            f'last_duration={self.last_duration:.3f} average_duration={self.average_duration:.3f}>'
+        )
+
+    def add(self, items=1, size=0):
+        """Record pending writes."""
+
+        was_full = self._is_full()
+
+        self.items += items
+        self.bytes += size
+
+        if self._pending_since is None:
+            self._event.set()
+            self._pending_since = time.monotonic()
+        elif not was_full and self._is_full():
+            self._event.set()
+
+    async def wait(self):
+        """Wait until a flush is due, or the scheduler is closed."""
+
+        while not self._closed:
+            if self._pending_since is None:
+                timeout = None
+            elif self._is_full():
+                return
+            else:
+                timeout = self._pending_since + self.max_delay * self.backoff - time.monotonic()
+
+                if timeout <= 0:
+                    return
+
+            self._event.clear()
+
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def start(self):
+        """Marks all pending writes as being flushed."""
+
+        self._batch = (self.items, self.bytes)
+        self._started_at = time.monotonic()
+
+        self.items = 0
+        self.bytes = 0
+
+        self._pending_since = None
+
+    def finish(self, success=True):
+        """Record the result of the flush started last."""
+
+        duration = time.monotonic() - self._started_at
+
+        self.flushes += 1
+        self.last_duration = duration
+
+        # Exponentially weighted, recent flushes matter the most
+        self.average_duration = self.average_duration * 0.8 + duration * 0.2
+
+        if not success:
+            self.failures += 1
+            self.add(*self._batch)  # Writes are retried
+
+        slow = self.slow_duration is not None and duration > self.slow_duration
+
+        if not success or slow:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        else:
+            self.backoff = max(self.backoff // 2, 1)
+
+        if self.name is None:
+            return
+
+        if not success:
+            level = logging.WARNING
+        elif slow:
+            level = logging.INFO
+        else:
+            level = logging.DEBUG
+
+        items, size = self._batch
+        result = 'Flushed' if success else 'Failed to flush'
+
+        log.log(
+            level,
+            f'{result} {items} {self.name} writes ({size} bytes) in {duration:.3f}s, '
+            f'average {self.average_duration:.3f}s, backoff {self.backoff}, {self.failures}/{self.flushes} failed.',
+        )
+
+    def close(self):
+        """Stop waiting for flushes to become due."""
+
+        self._closed = True
+        self._event.set()
+
+    def _is_full(self):
+        if self.max_items is not None and self.items >= self.max_items * self.backoff:
+            return True
+
+        return self.max_bytes is not None and self.bytes >= self.max_bytes * self.backoff